@@ -1,9 +1,16 @@
-# Read .rp, .acq, and other files in CPersist format.
+# Read and write .rp, .acq, and other files in CPersist format.
+#
+# A CPersist object is the header "WS1_" followed by (tag, type, value)
+# entries, and ends with the tag "EndOfParameters". Tags are strings
+# (an int count followed by that many bytes). Values of type Object are
+# themselves CPersist objects. The whole file is read into memory and
+# walked by offset; nested objects are only decoded when they are used.
 
-import os, sys
 from struct import Struct
+from .util import atomicWrite
 
 CPERSISTHDR = b"WS1_"
+ENDTAG = "EndOfParameters"
 
 be_int = Struct(">i")
 be_uint = Struct(">I")
@@ -13,101 +20,361 @@ be_long = Struct(">l")
 be_ulong = Struct(">L")
 be_double = Struct(">d")
 
-def get(f, s):
-    return s.unpack(f.read(s.size))[0]
+# Tag types.
 
-def getint(f):
-    return get(f, be_int)
+CUSTOM = 1
+OBJECT = 2
+BINARY = 3
+DOUBLE = 4
+INTEGER = 5
+SHORT = 6
+USHORT = 7
+BOOLEAN = 8
+CSTR32 = 9
+STRING = 10
+STRINGLIST = 11
+CSTR32LIST = 12
+SENSORCLASSLIST = 13
+LONG = 14
+ULONG = 15
+UINTEGER = 16
+CTFBOOLEAN = 17
 
-def getstr(f):
-    count = getint(f)
-    return f.read(count)
+# Scalar types, and the Struct used for each.
 
-def getCPersist(f):
-    s = f.read(4)
-    if s != CPERSISTHDR:
-        raise RuntimeError("improper CPersist file")
+SCALARS = {DOUBLE: be_double, INTEGER: be_int, SHORT: be_short,
+           USHORT: be_ushort, LONG: be_long, ULONG: be_ulong,
+           UINTEGER: be_uint, CTFBOOLEAN: be_int}
 
-    d = {}
-    while 1:
-        tag = getstr(f).decode()
-        if tag == "EndOfParameters":
-            break
-        tagtype = getint(f)
-        if tagtype == 1:                # Custom
-            if tag == "DataManagerStart":
-                # This tag has no data
-                v = None
-            elif tag == "DatasetFiles":
-                i = getint(f)
-                if i != 1:
-                    print('erk')
-                v = getstr(f)
-                get(f, be_short) # unknown
-            elif tag == "DisplaySets":
-                n = getint(f)
-                v = [None] * n
-                for i in range(n):
-                    v[i] = getCPersist(f)
-                getint(f)
-            elif tag == "ChannelSet":
-                v = getCPersist(f)
-            else:                       # punt
-                v = getCPersist(f)
-        elif tagtype == 2:              # Object
-            v = getCPersist(f)
-        elif tagtype == 3:              # Binary
-            v = getstr(f)
-        elif tagtype == 4:              # Double
-            v = get(f, be_double)
-        elif tagtype == 5:              # Integer
-            v = get(f, be_int)
-        elif tagtype == 6:              # Short
-            v = get(f, be_short)
-        elif tagtype == 7:              # UShort
-            v = get(f, be_ushort)
-        elif tagtype == 8:              # Boolean
-            v = f.read(1)
-            v = ord(bytes(v))           # works in py2 and py3
-        elif tagtype == 9:              # CStr32
-            print('CStr32')
-        elif tagtype == 10:             # String
-            v = getstr(f)
-        elif tagtype == 11:             # StringList
-            n = getint(f)
-            v = [None] * n
-            for i in range(n):
-                v[i] = getstr(f)
-        elif tagtype == 12:             # CStr32List
-            n = getint(f)
+CSTR32SIZE = 32
+
+def nullstrip(s):
+    i = s.find(b'\x00')
+    if i < 0:
+        return s
+    return s[:i]
+
+# Reading. Each function takes the buffer (a memoryview) and an offset,
+# and returns the value and the offset just past it.
+
+def getint(buf, off):
+    return be_int.unpack_from(buf, off)[0], off + be_int.size
+
+def getstr(buf, off):
+    count, off = getint(buf, off)
+    return bytes(buf[off : off + count]), off + count
+
+def getCstr(buf, off):
+    return nullstrip(bytes(buf[off : off + CSTR32SIZE])), off + CSTR32SIZE
+
+def getValue(buf, off, tag, tagtype):
+    """Decode the value of an entry. Nested objects are returned
+    undecoded, as cpObjects, so only their extent is found here.
+    Returns (value, extra, off), where extra holds any other fields
+    that must be kept to write the entry back."""
+
+    extra = None
+    if tagtype == CUSTOM:
+        if tag == "DataManagerStart":
+            # This tag has no data
+            v = None
+        elif tag == "DatasetFiles":
+            i, off = getint(buf, off)
+            v, off = getstr(buf, off)
+            u = be_short.unpack_from(buf, off)[0]   # unknown
+            off += be_short.size
+            extra = (i, u)
+        elif tag == "DisplaySets":
+            n, off = getint(buf, off)
             v = [None] * n
             for i in range(n):
-                v[i] = getCstr(f)
-        elif tagtype == 13:             # SensorClassList
-            pass
-        elif tagtype == 14:             # Long
-            v = get(f, be_long)
-        elif tagtype == 15:             # ULong
-            v = get(f, be_ulong)
-        elif tagtype == 16:             # UInteger
-            v = get(f, be_uint)
-        elif tagtype == 17:             # CTFBoolean
-            print('CTFbool')
+                v[i], off = getObject(buf, off)
+            extra, off = getint(buf, off)
+        else:                           # ChannelSet, and punt
+            v, off = getObject(buf, off)
+    elif tagtype == OBJECT:
+        v, off = getObject(buf, off)
+    elif tagtype in SCALARS:
+        s = SCALARS[tagtype]
+        v = s.unpack_from(buf, off)[0]
+        off += s.size
+    elif tagtype == BINARY or tagtype == STRING:
+        v, off = getstr(buf, off)
+    elif tagtype == BOOLEAN:
+        v = buf[off]
+        off += 1
+    elif tagtype == CSTR32:
+        v, off = getCstr(buf, off)
+    elif tagtype == STRINGLIST:
+        n, off = getint(buf, off)
+        v = [None] * n
+        for i in range(n):
+            v[i], off = getstr(buf, off)
+    elif tagtype == CSTR32LIST:
+        n, off = getint(buf, off)
+        v = [None] * n
+        for i in range(n):
+            v[i], off = getCstr(buf, off)
+    elif tagtype == SENSORCLASSLIST:
+        n, off = getint(buf, off)
+        v = list(Struct(">%di" % n).unpack_from(buf, off))
+        off += 4 * n
+    else:
+        raise NameError("unhandled tag type %d" % tagtype)
+
+    # _eeg_info is type 5, but it is special: its value
+    # is the number of following cpersist structures.
+
+    if tag == "_eeg_info":
+        n = v
+        v = [None] * n
+        for i in range(n):
+            v[i], off = getObject(buf, off)
+
+    return v, extra, off
+
+def getObject(buf, off):
+    """Return a lazy cpObject starting at off, and the offset of its end."""
+
+    o = cpObject(buf, off)
+    return o, o._end
+
+def _skip(buf, off):
+    """Walk the entries of the object at off without decoding them, and
+    return the offset just past its end."""
+
+    if bytes(buf[off : off + 4]) != CPERSISTHDR:
+        raise RuntimeError("improper CPersist file")
+    off += 4
+    while True:
+        tag, off = getstr(buf, off)
+        if tag == b"EndOfParameters":
+            return off
+        tagtype, off = getint(buf, off)
+        s = SCALARS.get(tagtype)
+        if s is not None and tag != b"_eeg_info":
+            off += s.size
+        elif tagtype == BINARY or tagtype == STRING:
+            n, off = getint(buf, off)
+            off += n
+        elif tagtype == CSTR32:
+            off += CSTR32SIZE
+        elif tagtype == OBJECT:
+            off = _skip(buf, off)
         else:
-            raise NameError("unhandled tag type %d" % tagtype)
+            off = getValue(buf, off, tag.decode(), tagtype)[2]
 
-        # _eeg_info is type 5, but it is special: its value
-        # is the number of following cpersist structures.
+class cpObject(object):
+    """A CPersist object, a mapping from tag names to values. The
+    entries are decoded the first time the object is used. The type of
+    each entry is kept in self.types, so the object can be written back
+    with writeCPersist() after it has been changed. New entries are
+    given a type from their value, see setType()."""
 
-        if tag == "_eeg_info":
-            n = v
-            v = [None] * n
-            for i in range(n):
-                v[i] = getCPersist(f)
+    def __init__(self, buf = None, off = 0):
+        self._buf = buf
+        self._off = off
+        self._items = None
+        self.types = {}
+        self.extra = {}
+        self.trailer = b''
+        if buf is None:
+            self._items = {}
+            self._end = 0
+        else:
+            self._end = _skip(buf, off)
+
+    def _parse(self):
+        if self._items is not None:
+            return self._items
+        buf = self._buf
+        off = self._off + 4
+        items = {}
+        while True:
+            tag, off = getstr(buf, off)
+            tag = tag.decode()
+            if tag == ENDTAG:
+                break
+            tagtype, off = getint(buf, off)
+            items[tag], extra, off = getValue(buf, off, tag, tagtype)
+            self.types[tag] = tagtype
+            if extra is not None:
+                self.extra[tag] = extra
+        self._items = items
+        return items
+
+    def __getitem__(self, tag):
+        return self._parse()[tag]
+
+    def __setitem__(self, tag, v):
+        items = self._parse()
+        if tag not in self.types:
+            self.types[tag] = setType(v)
+        items[tag] = v
+
+    def __delitem__(self, tag):
+        del self._parse()[tag]
+        del self.types[tag]
+        self.extra.pop(tag, None)
+
+    def __contains__(self, tag):
+        return tag in self._parse()
+
+    def __iter__(self):
+        return iter(self._parse())
+
+    def __len__(self):
+        return len(self._parse())
+
+    def get(self, tag, default = None):
+        return self._parse().get(tag, default)
+
+    def keys(self):
+        return self._parse().keys()
+
+    def items(self):
+        return self._parse().items()
+
+    def todict(self):
+        """Decode everything, and return nested dicts and lists."""
+
+        def conv(v):
+            if isinstance(v, cpObject):
+                return v.todict()
+            if isinstance(v, list):
+                return [conv(x) for x in v]
+            return v
+
+        return {tag: conv(v) for tag, v in self.items()}
+
+def setType(v):
+    """Return the tag type used for a new entry with value v."""
+
+    if isinstance(v, (cpObject, dict)):
+        return OBJECT
+    if isinstance(v, bool):
+        return BOOLEAN
+    if isinstance(v, int):
+        return INTEGER
+    if isinstance(v, float):
+        return DOUBLE
+    if isinstance(v, (bytes, str)):
+        return STRING
+    if isinstance(v, list) and all(isinstance(x, (bytes, str)) for x in v):
+        return STRINGLIST
+    raise TypeError("no CPersist type for %r" % (v,))
+
+def readCPersist(filename):
+    """Read a CPersist file, and return the top level cpObject. Any
+    bytes after it (e.g. the last unnamed struct of .acq files) are kept
+    in its trailer, and written back by writeCPersist()."""
+
+    with open(filename, 'rb') as f:
+        buf = memoryview(f.read())
+    o, off = getObject(buf, 0)
+    o.trailer = bytes(buf[off:])
+    return o
+
+def getCPersist(f):
+    """Read a CPersist object from the open file f, and return it as
+    nested dicts. The file is left just past the object."""
+
+    pos = f.tell()
+    buf = memoryview(f.read())
+    o, off = getObject(buf, 0)
+    f.seek(pos + off)
+    return o.todict()
+
+# Writing.
+
+def putint(out, i):
+    out.append(be_int.pack(i))
+
+def putstr(out, s):
+    if isinstance(s, str):
+        s = s.encode()
+    putint(out, len(s))
+    out.append(s)
+
+def putCstr(out, s):
+    if isinstance(s, str):
+        s = s.encode()
+    if len(s) > CSTR32SIZE:
+        raise ValueError("string too long for CStr32: %r" % s)
+    out.append(s.ljust(CSTR32SIZE, b'\x00'))
+
+def putValue(out, tag, tagtype, v, extra):
+    """Append the encoded value of an entry to the list out."""
+
+    if tag == "_eeg_info":
+        putint(out, len(v))
+        for x in v:
+            putObject(out, x)
+        return
+
+    if tagtype == CUSTOM:
+        if tag == "DataManagerStart":
+            pass
+        elif tag == "DatasetFiles":
+            i, u = extra if extra is not None else (1, 0)
+            putint(out, i)
+            putstr(out, v)
+            out.append(be_short.pack(u))
+        elif tag == "DisplaySets":
+            putint(out, len(v))
+            for x in v:
+                putObject(out, x)
+            putint(out, extra if extra is not None else 0)
+        else:
+            putObject(out, v)
+    elif tagtype == OBJECT:
+        putObject(out, v)
+    elif tagtype in SCALARS:
+        out.append(SCALARS[tagtype].pack(v))
+    elif tagtype == BINARY or tagtype == STRING:
+        putstr(out, v)
+    elif tagtype == BOOLEAN:
+        out.append(bytes([v]))
+    elif tagtype == CSTR32:
+        putCstr(out, v)
+    elif tagtype == STRINGLIST:
+        putint(out, len(v))
+        for s in v:
+            putstr(out, s)
+    elif tagtype == CSTR32LIST:
+        putint(out, len(v))
+        for s in v:
+            putCstr(out, s)
+    elif tagtype == SENSORCLASSLIST:
+        putint(out, len(v))
+        out.append(Struct(">%di" % len(v)).pack(*v))
+    else:
+        raise NameError("unhandled tag type %d" % tagtype)
+
+def putObject(out, o):
+    """Append the encoding of the object o (a cpObject or a dict) to the
+    list out. Objects that were never decoded are copied as they are."""
 
-        d[tag] = v
+    if isinstance(o, cpObject) and o._items is None:
+        out.append(o._buf[o._off : o._end])
+        return
+    out.append(CPERSISTHDR)
+    types = o.types if isinstance(o, cpObject) else {}
+    extra = o.extra if isinstance(o, cpObject) else {}
+    for tag, v in o.items():
+        tagtype = types.get(tag)
+        if tagtype is None:
+            tagtype = setType(v)
+        putstr(out, tag)
+        putint(out, tagtype)
+        putValue(out, tag, tagtype, v, extra.get(tag))
+    putstr(out, ENDTAG)
 
-    # .acq files have one more unnamed cpersist struct at the end,
-    # but it isn't very interesting so we can ignore it.
+def writeCPersist(filename, o):
+    """Write the object o, and its trailer, to a CPersist file, with
+    util.atomicWrite()."""
 
-    return d
+    out = []
+    putObject(out, o)
+    out.append(getattr(o, 'trailer', b''))
+    atomicWrite(filename, out)
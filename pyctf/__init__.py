@@ -1,5 +1,8 @@
 from .dsopen import dsopen
 from . import ctf_res4 as ctf
-from . import fid, util
-from .getfidrot import getfidrot
-from .segments import get_segment_list, onlyTrials
+from . import fid, util, balance
+from .getfidrot import getfidrot, getfidrot_batch
+from .segments import get_segment_list, get_segment_arrays, onlyTrials, \
+    excludeTrials, selectTrials
+from .parallel import dsmap
+from .dswrite import dsWriter, dsSubset
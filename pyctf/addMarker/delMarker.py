@@ -1,7 +1,6 @@
 #! /usr/bin/env python
 
 import sys, os, os.path
-import tempfile
 import pyctf
 
 __usage = """mark dataset
@@ -15,64 +14,31 @@ def printerror(s):
 def printusage():
     sys.stderr.write("usage: %s %s\n" % (__scriptname, __usage))
 
-if len(sys.argv) != 3:
-    printusage()
-    sys.exit(1)
-
-marker = sys.argv[1]
-dsname = sys.argv[2]
-
-ds = pyctf.dsopen(dsname)
-
-if ds.marks.get(marker) is None:
-    printerror("No such mark {} in {}.".format(marker, dsname))
-    sys.exit(1)
-
-goodmarks = [mark for mark in ds.marks.keys() if mark != marker]
-
-# First, extract all the good marks from the dataset, and write them
-# to temporary files.
-
-TempDir = tempfile.mkdtemp()
-assert len(TempDir) != 0
-
-def cleanup(normal = False):
-    os.system("rm -rf {}".format(TempDir))
-    if not normal:
+def main():
+    if len(sys.argv) != 3:
+        printusage()
         sys.exit(1)
-    sys.exit(0)
-
-d = {}
-try:
-    for mark in goodmarks:
-
-        # Create a unique filename for the mark.
 
-        fd, name = tempfile.mkstemp(dir = TempDir, text = True)
-        f = os.fdopen(fd, 'w')
-        d[mark] = name
+    marker = sys.argv[1]
+    dsname = sys.argv[2]
 
-        # Write it out.
+    ds = pyctf.dsopen(dsname, lazy = True)
 
-        for tr, t in ds.marks[mark]:
-            f.write("{} {}\n".format(tr, t))
-
-        f.close()
-except Exception as msg:
-    printerror(msg)
-    cleanup()
-
-# Now delete the old MarkerFile.mrk, and recreate it.
+    if ds.marks.get(marker) is None:
+        printerror("No such mark {} in {}.".format(marker, dsname))
+        sys.exit(1)
 
-mrk = ds.getDsFileName("MarkerFile.mrk")
-os.system("rm -f {}".format(mrk))
+    # Rewrite MarkerFile.mrk without it. If no marks remain, remove the file.
 
-if len(goodmarks) == 0:
-    cleanup(True)
+    ds.marks.delMark(marker)
+    if len(ds.marks) == 0:
+        os.remove(ds.getDsFileName("MarkerFile.mrk"))
+        sys.exit(0)
+    ds.marks.write()
 
-print("Remaining marks:")
-for mark in goodmarks:
-    print(mark)
-    os.system("addMarker.py '{}' {} {}".format(mark, d[mark], dsname))
+    print("Remaining marks:")
+    for mark in ds.marks.keys():
+        print(mark)
 
-cleanup(True)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# Synthetic gradiometer balancing.
+
+import numpy as np
+from . import ctf_res4 as ctf
+
+# Names of the balancing coefficient sets, by gradient order.
+
+GRADES = ['G1BR', 'G2BR', 'G3BR']
+
+def gradOrder(r):
+    """Return an array with the gradient order that has already been
+    applied to the data of each primary channel (0 means unbalanced)."""
+
+    p0 = r.firstPrimary
+    return r.chanTable.gradOrder[p0 : p0 + r.numPrimaries]
+
+def _order(order):
+    if isinstance(order, str):
+        if order not in GRADES:
+            raise ValueError("unknown gradient order '%s'" % order)
+        return GRADES.index(order) + 1
+    if order not in (0, 1, 2, 3):
+        raise ValueError("unknown gradient order %s" % order)
+    return order
+
+def coeffMatrix(r, order, rows = None):
+    """Return the (numPrimaries, numRefs) matrix of the balancing
+    coefficients of the given order, which may be 0, 1, 2, 3 or one
+    of 'G1BR', 'G2BR', 'G3BR'. Row i holds the coefficients of primary
+    channel firstPrimary + i. The .res4 coefficients are in phi0 units;
+    they are rescaled by the channel gains so they apply to data in Tesla.
+    A ValueError is raised if a primary (or, if the boolean array rows
+    is given, one of those primaries) has no coefficients of that order."""
+
+    order = _order(order)
+    P = r.numPrimaries
+    R = r.numRefs
+    B = np.zeros((P, R))
+    if order == 0:
+        return B
+    if R == 0:
+        raise ValueError("no reference channels")
+    name = GRADES[order - 1].encode()
+    found = np.zeros(P, dtype = bool)
+    for ci in r.coeff:
+        if ctf.nullstrip(ci[ctf.ci_type]) != name:
+            continue
+        i = r.chanIndex[ci[ctf.ci_sensorName]] - r.firstPrimary
+        if i < 0 or i >= P:
+            continue        # references are balanced too; skip them
+        found[i] = True
+        for cn, cidx, c in ci[ctf.ci_sensorList]:
+            j = cidx - r.firstRef
+            if j < 0 or j >= R:
+                raise ValueError("balancing channel %s is not a reference" % cn)
+            B[i, j] = c
+
+    if rows is not None:
+        found |= ~rows
+    missing = np.flatnonzero(~found)
+    if len(missing):
+        raise ValueError("no %s coefficients for channel %s" %
+            (GRADES[order - 1], r.chanFname[r.firstPrimary + missing[0]]))
+
+    # Scale by properGain * qGain, reference over primary.
+
+    sr = r.sensArray['sr']
+    g = sr['properGain'] * sr['qGain']
+    pri = g[r.firstPrimary : r.firstPrimary + P]
+    ref = g[r.firstRef : r.firstRef + R]
+    B *= ref[None, :] / pri[:, None]
+    return B
+
+def balanceMatrix(r, order):
+    """Return the (numPrimaries, numRefs) matrix B that takes the primary
+    data of r, as stored, to the given gradient order, with
+
+        balanced = pri - B.dot(ref)
+
+    Data that is already balanced is first unbalanced, so B is the
+    difference between the target coefficients and the stored ones.
+    The data are in Tesla, as returned by getPriArray()/getRefArray()."""
+
+    B = coeffMatrix(r, order)
+    cur = gradOrder(r)
+    for k in np.unique(cur):
+        if k != 0:
+            rows = cur == k
+            B[rows] -= coeffMatrix(r, k, rows)[rows]
+    return B
+
+def balance(B, pri, ref):
+    """Apply the balancing matrix B to a block of primary data, in place.
+    pri and ref are (channels, samples) arrays for the same samples, or
+    (segments, channels, samples) stacks. Returns pri."""
+
+    pri -= np.matmul(B, ref)
+    return pri
+
+if __name__ == '__main__':
+    # Two primaries and two references whose gains differ; the primaries
+    # were recorded unbalanced, and G1BR is applied. The coefficients act
+    # on the data in phi0 units (Tesla times properGain * qGain), so the
+    # balanced result must match the balanced phi0 data, back in Tesla.
+
+    from types import SimpleNamespace
+    M = 4
+    sr = np.zeros(M, dtype = ctf.SensorResDtype)
+    sr['properGain'] = [1e8, 2e8, .2e8, .5e8]
+    sr['qGain'] = [1e4, 1e4, 1e4, 2e4]
+    sens = np.zeros(M, dtype = ctf.SensorDtype)
+    sens['sr'] = sr
+    names = ['P1', 'P2', 'R1', 'R2']
+    C = np.array([[.1, -.2], [.3, .05]])
+    coeff = []
+    for i in range(2):
+        sl = [(names[2 + j], 2 + j, C[i, j]) for j in range(2)]
+        coeff.append([names[i], b'G1BR', 2, sl] + list(C[i]))
+    r = SimpleNamespace(numPrimaries = 2, numRefs = 2, firstPrimary = 0,
+        firstRef = 2, chanIndex = {n: i for i, n in enumerate(names)},
+        chanFname = names,
+        coeff = coeff, sensArray = sens,
+        chanTable = SimpleNamespace(gradOrder = np.zeros(M, dtype = int)))
+
+    rng = np.random.default_rng(0)
+    g = sr['properGain'] * sr['qGain']
+    phi = rng.normal(size = (M, 100))
+    want = (phi[:2] - C.dot(phi[2:])) / g[:2, None]
+    tesla = phi / g[:, None]
+    got = balance(balanceMatrix(r, 'G1BR'), tesla[:2], tesla[2:])
+    print("balance check:", "ok" if np.allclose(got, want) else "FAILED")
+
+    # Now take the balanced data back to unbalanced.
+
+    r.chanTable.gradOrder[:2] = 1
+    got = balance(balanceMatrix(r, 0), want.copy(), tesla[2:])
+    print("unbalance check:", "ok" if np.allclose(got, tesla[:2]) else "FAILED")
+
+    # A primary without coefficients of the order asked for is an error.
+
+    del r.coeff[1]
+    for order in ('G1BR', 0):
+        try:
+            balanceMatrix(r, order)
+            print("missing check: FAILED")
+        except ValueError as e:
+            print("missing check: ok,", e)
@@ -0,0 +1,191 @@
+# Keep an SQLite catalog of the CTF datasets under some directories, so
+# that questions like "which datasets have marker X at 1200 Hz" can be
+# answered without opening every dataset.
+
+import os, sys, sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from . import ctf_res4 as ctf
+from .markers import markerCounts
+from . import util
+
+__all__ = ['findDatasets', 'updateCatalog', 'queryCatalog']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    path TEXT PRIMARY KEY,
+    res4mtime REAL, mrkmtime REAL,
+    srate REAL, ntrials INTEGER, nsamples INTEGER, nchannels INTEGER,
+    date TEXT, time TEXT, runname TEXT);
+CREATE TABLE IF NOT EXISTS chantypes (
+    path TEXT, type INTEGER, count INTEGER);
+CREATE TABLE IF NOT EXISTS markers (
+    path TEXT, name TEXT, count INTEGER);
+CREATE INDEX IF NOT EXISTS chantypes_path ON chantypes (path);
+CREATE INDEX IF NOT EXISTS markers_path ON markers (path);
+CREATE INDEX IF NOT EXISTS markers_name ON markers (name);
+"""
+
+def findDatasets(root):
+    """Return a list of the absolute paths of all the *.ds directories in
+    the tree under root. Datasets are not searched for more datasets."""
+
+    l = []
+    for dirpath, dirs, files in os.walk(os.path.abspath(root)):
+        ds = [d for d in dirs if d.endswith('.ds')]
+        l.extend(os.path.join(dirpath, d) for d in ds)
+        dirs[:] = [d for d in dirs if not d.endswith('.ds')]
+    return sorted(l)
+
+def _mtimes(dsname):
+    """Return the modification times of the .res4 and marker files."""
+
+    setname = os.path.basename(dsname)[:-3]
+    res4 = os.path.getmtime(os.path.join(dsname, setname + '.res4'))
+    try:
+        mrk = os.path.getmtime(os.path.join(dsname, 'MarkerFile.mrk'))
+    except OSError:
+        mrk = 0.
+    return res4, mrk
+
+def _scan(dsname):
+    """Read the catalog information of one dataset. This runs in the pool,
+    so it returns plain data: (path, mtimes, row, chantypes, markers)."""
+
+    mt = _mtimes(dsname)
+    setname = os.path.basename(dsname)[:-3]
+    r = ctf.readRes4Header(os.path.join(dsname, setname + '.res4'))
+    types = {}
+    for t in r.chanType.tolist():
+        types[t] = types.get(t, 0) + 1
+    row = (r.sampleRate, r.numTrials, r.numSamples, r.numChannels,
+           r.date, r.time, r.runName)
+    return dsname, mt, row, types, markerCounts(dsname)
+
+def updateCatalog(dbname, roots, nproc = None, processes = False, prune = True):
+    """Add the datasets under the directories in roots to the catalog
+    dbname, creating it if needed. Datasets whose .res4 and MarkerFile.mrk
+    modification times are unchanged since the last update are skipped.
+    Parsing is done by nproc threads (or processes, if processes is
+    true). If prune is true, entries for datasets under roots that no
+    longer exist are removed. Returns the numbers of datasets
+    (updated, unchanged, removed)."""
+
+    if isinstance(roots, str):
+        roots = [roots]
+    db = sqlite3.connect(dbname)
+    db.executescript(SCHEMA)
+    known = {p: (a, b) for p, a, b in
+             db.execute("SELECT path, res4mtime, mrkmtime FROM datasets")}
+
+    found = []
+    todo = []
+    same = 0
+    for root in roots:
+        for ds in findDatasets(root):
+            found.append(ds)
+            try:
+                mt = _mtimes(ds)
+            except OSError:
+                continue        # no .res4 file
+            if known.get(ds) != mt:
+                todo.append(ds)
+            else:
+                same += 1
+
+    removed = 0
+    if prune:
+        roots = [os.path.join(os.path.abspath(r), '') for r in roots]
+        fset = set(found)
+        gone = [p for p in known if p not in fset and
+                any(p.startswith(r) for r in roots)]
+        for p in gone:
+            _delete(db, p)
+        removed = len(gone)
+
+    Pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    updated = 0
+    with Pool(nproc) as pool:
+        futures = [(ds, pool.submit(_scan, ds)) for ds in todo]
+        for ds, fu in futures:
+            try:
+                path, mt, row, types, marks = fu.result()
+            except Exception as e:
+                print("[pyctf] Note: {}: {}".format(ds, e), file = sys.stderr)
+                continue
+            _delete(db, path)
+            db.execute("INSERT INTO datasets VALUES (?,?,?,?,?,?,?,?,?,?)",
+                (path,) + mt + row)
+            db.executemany("INSERT INTO chantypes VALUES (?,?,?)",
+                [(path, t, n) for t, n in types.items()])
+            db.executemany("INSERT INTO markers VALUES (?,?,?)",
+                [(path, m, n) for m, n in marks.items()])
+            updated += 1
+    db.commit()
+    db.close()
+    return updated, same, removed
+
+def _delete(db, path):
+    for table in ('datasets', 'chantypes', 'markers'):
+        db.execute("DELETE FROM %s WHERE path = ?" % table, (path,))
+
+def queryCatalog(dbname, marker = None, srate = None, chantype = None):
+    """Return the paths of the datasets in the catalog that have the
+    named marker, the sample rate srate, and at least one channel of
+    type chantype (e.g. ctf.TYPE_EEG). Criteria that are None are
+    ignored."""
+
+    q = "SELECT d.path FROM datasets d WHERE 1"
+    args = []
+    if marker is not None:
+        q += " AND EXISTS (SELECT 1 FROM markers m WHERE m.path = d.path AND m.name = ?)"
+        args.append(marker)
+    if srate is not None:
+        q += " AND abs(d.srate - ?) < .001"
+        args.append(srate)
+    if chantype is not None:
+        q += " AND EXISTS (SELECT 1 FROM chantypes c WHERE c.path = d.path AND c.type = ?)"
+        args.append(chantype)
+    q += " ORDER BY d.path"
+    db = sqlite3.connect(dbname)
+    try:
+        return [p for p, in db.execute(q, args)]
+    finally:
+        db.close()
+
+def main():
+    util.usage("""[-d db] [-j n] [-p] [-m marker] [-r srate] [dir ...]
+Update the dataset catalog db (default pyctf.db) with the datasets found
+under each dir, using n parallel workers (-p: processes instead of
+threads). With -m and/or -r, print the datasets in the catalog that
+have the given marker and/or sample rate.""")
+
+    optlist, args = util.parseargs("d:j:pm:r:")
+    dbname = 'pyctf.db'
+    nproc = None
+    processes = False
+    marker = None
+    srate = None
+    for opt, arg in optlist:
+        if opt == '-d':
+            dbname = arg
+        elif opt == '-j':
+            nproc = int(arg)
+        elif opt == '-p':
+            processes = True
+        elif opt == '-m':
+            marker = arg
+        elif opt == '-r':
+            srate = float(arg)
+    if not args and marker is None and srate is None:
+        util.printusage()
+        sys.exit(1)
+
+    if args:
+        n, same, gone = updateCatalog(dbname, args, nproc, processes)
+        util.msg("%d updated, %d unchanged, %d removed\n" % (n, same, gone))
+    if marker is not None or srate is not None:
+        for p in queryCatalog(dbname, marker, srate):
+            print(p)
+
+if __name__ == '__main__':
+    main()
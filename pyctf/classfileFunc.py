@@ -1,45 +1,118 @@
 
 import os
-import textwrap
-
-def writeClassFile(fname_out):       
-
-    file_content = f"""\
-    PATH OF DATASET:
-    {fname_out}
-
-    
-    NUMBER OF CLASSES:
-    1
-
-
-    CLASSGROUPID:
-    3
-    NAME:
-    BAD
-    COMMENT:
-
-    COLOR:
-    Red
-    EDITABLE:
-    Yes
-    CLASSID:
-    1
-    NUMBER OF TRIALS:
-    0
-    LIST OF TRIALS:
-    TRIAL NUMBER
-
-
-    """
-
-    file_content = textwrap.dedent(file_content)
-
-    # Write the file content to a file
-    with open(f"{fname_out}/ClassFile.cls", "w") as file:
-        file.write(file_content)
-
-
+import numpy as np
+from .util import atomicWrite, parseRecords, formatRecords
+
+# The trial lists of the classes in ClassFile.cls are kept as numpy arrays.
+
+class classes:
+    """Access to the trial classes of a CTF dataset (ClassFile.cls). Each
+    class name is a key that returns a sorted array of trial numbers. The
+    other fields of each class (COMMENT, COLOR, etc.) are kept in
+    self.info[name]. A missing ClassFile.cls has no classes. With read
+    false, the file is not read, so write() replaces all the classes."""
+
+    def __init__(self, dsname, read = True):
+        self.cl = {}            # trial arrays
+        self.info = {}          # the other fields of each class
+        self.dsname = dsname
+        if not read:
+            return
+        try:
+            self.cl, self.info = readClassFile(dsname)
+        except FileNotFoundError:
+            pass
+
+    def __getitem__(self, key):
+        return self.cl[key]
+
+    def get(self, key):
+        return self.cl.get(key)
+
+    def keys(self):
+        return self.cl.keys()
+
+    def __contains__(self, key):
+        return key in self.cl
+
+    def __len__(self):
+        return len(self.cl)
+
+    def trials(self, key):
+        """Return the trials of class key, or an empty array if there is
+        no such class."""
+
+        t = self.cl.get(key)
+        if t is None:
+            return np.zeros(0, dtype = int)
+        return t
+
+    def setClass(self, name, trials, **info):
+        """Add the class name, or replace its trials if it exists. Keyword
+        arguments set the other fields of the class, e.g. COLOR = 'Red'.
+        The file is not changed until write() is called."""
+
+        d = {'CLASSGROUPID': '3', 'NAME': name, 'COMMENT': '',
+             'COLOR': 'Red', 'EDITABLE': 'Yes'}
+        d.update(self.info.get(name, {}))
+        d.update(info)
+        self.cl[name] = np.unique(np.asarray(trials, dtype = int))
+        self.info[name] = d
+
+    def addTrials(self, name, trials, **info):
+        """Add trials to the class name, creating it if needed."""
+
+        t = np.concatenate((self.trials(name), np.asarray(trials, dtype = int).ravel()))
+        self.setClass(name, t, **info)
+
+    def delClass(self, name):
+        """Delete the class name. The file is not changed until write()."""
+
+        del self.cl[name]
+        del self.info[name]
+
+    def write(self, filename = None):
+        """Write all the classes to ClassFile.cls (or filename). The new
+        file is written with util.atomicWrite(). Classes are numbered in
+        order."""
+
+        if filename is None:
+            filename = os.path.join(self.dsname, 'ClassFile.cls')
+        records = [(name, self.info[name], list(map("{:+20d}\n".format, t.tolist())))
+                   for name, t in self.cl.items()]
+        atomicWrite(filename, formatRecords(self.dsname, 'CLASSES', 'TRIALS',
+                                            "TRIAL NUMBER", records))
+
+def readClassFile(dsname):
+    """Read the ClassFile.cls of a dataset. Returns two dicts, mapping
+    each class name to a sorted array of its trial numbers, and to a dict
+    of its other fields."""
+
+    with open(os.path.join(dsname, 'ClassFile.cls')) as f:
+        lines = f.read().split('\n')
+
+    # The trials of each class are converted in one go.
+
+    cl = {}
+    infos = {}
+    for info, rows in parseRecords(lines, 'TRIALS'):
+        name = info.get('NAME', '')
+        if rows:
+            t = np.loadtxt(rows, dtype = int, ndmin = 1)
+        else:
+            t = np.zeros(0, dtype = int)
+        cl[name] = np.unique(t)
+        infos[name] = info
+    return cl, infos
+
+def writeClassFile(fname_out, bad = ()):
+    """Write ClassFile.cls in the dataset fname_out, with one class, BAD,
+    listing the trial numbers in bad (default none). Any other classes
+    are lost; use classes() to change one class and keep the rest."""
+
+    c = classes(fname_out, read = False)
+    c.setClass('BAD', bad)
+    c.write()
 
 def checkClassFile(fname):
 
@@ -53,31 +126,5 @@ def checkClassFile(fname):
         Path String.
 
     '''
-    was_aborted = False
-    
-    # Open the file
-    with open(os.path.join(fname,'ClassFile.cls'), "r") as file:
-        # Initialize variables to store class information
-        number_of_class = None
-        names = []
-
-        # Read the file line by line
-        for line in file:
-            # Strip whitespace characters from the beginning and end of each line
-            line = line.strip()
-
-            # Check if the line contains "NUMBER OF CLASSES"
-            if line.startswith("NUMBER OF CLASSES:"):
-                # The actual number is on the next line
-                number_of_class = int(next(file).strip())
-            # Check if the line contains "NAME"
-            elif line.startswith("NAME:"):
-                # The actual name is on the next line
-                names.append(next(file).strip())
-                if "Aborted" in names:
-                    was_aborted = True
-                # Break the loop if all names are collected
-                if len(names) == number_of_class:
-                    break
-
-    return was_aborted 
\ No newline at end of file
+
+    return "Aborted" in readClassFile(fname)[0]
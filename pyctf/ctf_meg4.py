@@ -1,91 +1,594 @@
-import sys
+import sys, os
+from collections import OrderedDict
 import numpy as np
+from . import ctf_res4 as ctf
+from .util import atomicWrite
 
 MEG4HDR = "MEG41CP\x00"
 
+# Channel types kept in the float32 sidecar. The others (trigger, head
+# coil, ADC, ... channels) hold integer codes or need their full precision,
+# so they are always read from the .meg4 file.
+
+SIDECAR_TYPES = (ctf.TYPE_REF_MAG, ctf.TYPE_REF_GRAD, ctf.TYPE_MAG_SENS, ctf.TYPE_MEG)
+
+def meg4Parts(meg4name):
+    """Return the list of files holding the data of a .meg4 file. Large
+    datasets are split into <set>.meg4, <set>.1_meg4, <set>.2_meg4, ..."""
+
+    parts = [meg4name]
+    base = meg4name[:-len('.meg4')]
+    i = 1
+    while True:
+        name = "%s.%d_meg4" % (base, i)
+        if not os.path.exists(name):
+            break
+        parts.append(name)
+        i += 1
+    return parts
+
+def encode(x, gain):
+    """Convert scaled data x back to raw samples: undo the gain, round,
+    and clip to the int32 range. Returns big-endian data viewed as int32,
+    the way it is stored in the memmap."""
+
+    a = np.divide(x, gain)
+    np.rint(a, out = a)
+    np.clip(a, -2**31, 2**31 - 1, out = a)
+    return a.astype('>i4').view('int32')
+
+class splitMap(object):
+    """Present the (T_i, C, S) memmaps of a split .meg4 file as a single
+    (T, C, S) array. The first index must be an integer trial; the rest of
+    the key is passed on to the memmap that holds that trial."""
+
+    def __init__(self, maps):
+        self.maps = maps
+        n = [m.shape[0] for m in maps]
+        self.trial0 = np.cumsum([0] + n)
+        self.shape = (int(self.trial0[-1]),) + maps[0].shape[1:]
+        self.dtype = maps[0].dtype
+
+    def _locate(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        tr = key[0]
+        if not isinstance(tr, (int, np.integer)):
+            raise TypeError("split datasets must be indexed one trial at a time")
+        if tr < 0:
+            tr += self.shape[0]
+        if tr < 0 or tr >= self.shape[0]:
+            raise IndexError("trial %d out of range" % key[0])
+        i = np.searchsorted(self.trial0, tr, side = 'right') - 1
+        return self.maps[i], (tr - self.trial0[i],) + key[1:]
+
+    def __getitem__(self, key):
+        m, key = self._locate(key)
+        return m[key]
+
+    def __setitem__(self, key, value):
+        m, key = self._locate(key)
+        m[key] = value
+
+    def flush(self):
+        for m in self.maps:
+            m.flush()
+
+class writeMap(object):
+    """Wrap the writable memmap of a dsData object. The memmap is only
+    created on first use, and assignments through it invalidate the
+    cached copies of the trials written."""
+
+    def __init__(self, d):
+        self.d = d
+        self._map = None
+
+    @property
+    def map(self):
+        if self._map is None:
+            self._map = self.d._open('r+')
+        return self._map
+
+    def __getitem__(self, key):
+        return self.map[key]
+
+    def __setitem__(self, key, value):
+        tr = key[0] if isinstance(key, tuple) else key
+        self.d.invalidate(tr)
+        self.map[key] = value
+
+    def __getattr__(self, name):
+        return getattr(self.map, name)
+
 class dsData(object):
-    """mmap() the .meg4 file. Return byteswapped, scaled arrays of data."""
+    """mmap() the .meg4 file. Return byteswapped, scaled arrays of data.
+    A .meg4 file that has been split into several parts is mapped part by
+    part, and the parts are presented as one trial axis. Decoded trials
+    may be kept in an LRU cache of up to cache bytes, see setCache(), or
+    the whole dataset may be read from a float32 sidecar, see
+    useSidecar(). The writable map self.w is opened on first use."""
 
-    def __init__(self, r, meg4name):
+    def __init__(self, r, meg4name, cache = 0):
         self.r = r
         self.T = r.numTrials
         self.C = r.numChannels
         self.S = r.numSamples
-        self.m = np.memmap(meg4name, dtype = 'int32', mode = 'r',
-            shape = (self.T, self.C, self.S), offset = len(MEG4HDR))
+        self.meg4name = meg4name
+        self.readonly = False
+        self.parts = self._parts()
+        self.m = self._open('r')
+        self.w = writeMap(self)
+        self.f = None           # float32 sidecar, see useSidecar()
+        self.fidx = np.flatnonzero(np.isin(r.chanType, SIDECAR_TYPES))
+        self.fpos = np.full(self.C, -1)     # row of each channel in the sidecar
+        self.fpos[self.fidx] = np.arange(len(self.fidx))
+        self.dtype = np.float64 # default type of the returned arrays
+        self.cache = OrderedDict()
+        self.cacheUsed = 0
+        self.hits = 0
+        self.misses = 0
+        self.setCache(cache)
+
+    def _parts(self):
+        """Return a list of (filename, number of trials) for each part
+        of the .meg4 file."""
+
+        parts = meg4Parts(self.meg4name)
+        if len(parts) == 1:
+            return [(self.meg4name, self.T)]
+
+        # Each part has its own header and holds a whole number of trials.
+
+        tsize = self.C * self.S * 4
+        ntr = []
+        for name in parts:
+            n, rem = divmod(os.path.getsize(name) - len(MEG4HDR), tsize)
+            if rem != 0:
+                raise ValueError("%s does not hold a whole number of trials" % name)
+            ntr.append(n)
+        if sum(ntr) != self.T:
+            raise ValueError("%s: found %d trials in %d parts, expected %d" %
+                (self.meg4name, sum(ntr), len(parts), self.T))
+        return list(zip(parts, ntr))
+
+    def _open(self, mode):
+        """Return a map of the whole .meg4 file. If the file can't be
+        opened for writing, the read-only map is returned instead."""
+
         try:
-            self.w = np.memmap(meg4name, dtype = 'int32', mode = 'r+',
-                shape = (self.T, self.C, self.S), offset = len(MEG4HDR))
+            maps = [np.memmap(name, dtype = 'int32', mode = mode,
+                        shape = (n, self.C, self.S), offset = len(MEG4HDR))
+                    for name, n in self.parts]
         except PermissionError as e:
+            if mode == 'r':
+                raise
             print("[pyctf] Note: .meg4 file is read-only", file = sys.stderr)
-            self.w = self.m
+            self.readonly = True
+            return self.m
+        if len(maps) == 1:
+            return maps[0]
+        return splitMap(maps)
 
     def close(self):
         # call this to release the memory
         del self.w
         del self.m
+        self.f = None
+        self.cache.clear()
+
+    def setCache(self, nbytes):
+        """Keep up to nbytes of decoded (native-endian, scaled) trials in
+        memory, evicting the least recently used ones first. Reads of a
+        cached trial skip the byteswap and gain multiply. 0 turns the
+        cache off and empties it."""
+
+        self.cacheSize = nbytes
+        self._evict(0)
+
+    def makeSidecar(self, name):
+        """Convert the MEG channels (see SIDECAR_TYPES) of the whole
+        dataset, one trial at a time, into a file of native-endian float32
+        samples with the gains applied, shaped (T, len(self.fidx), S). See
+        util.atomicWrite()."""
+
+        gain = self.r.chanGain[self.fidx]
+        atomicWrite(name, (self._decode(self.m[tr, self.fidx], gain, False,
+                                        np.float32, None)
+                           for tr in range(self.T)))
+
+    def sidecarSize(self):
+        """Return the size in bytes of a sidecar file for this dataset."""
+
+        return self.T * len(self.fidx) * self.S * 4
+
+    def useSidecar(self, name):
+        """Read the MEG channels from the sidecar file made by
+        makeSidecar(). Their samples have float32 precision; the other
+        channels are still read exactly from the .meg4 file. Reads return
+        float64 copies by default; reads that don't remove the mean and
+        ask for dtype numpy.float32 return read-only views of the file.
+        Writing through self.w stops using (and removes) the now stale
+        sidecar."""
+
+        self.f = np.memmap(name, dtype = np.float32, mode = 'r',
+            shape = (self.T, len(self.fidx), self.S))
+        self.fname = name
+        self.invalidate()
+
+    def cacheInfo(self):
+        """Return a dict with the cache hit and miss counts, the number of
+        trials held, and the bytes used and allowed."""
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'trials': len(self.cache), 'used': self.cacheUsed,
+                'size': self.cacheSize}
+
+    def invalidate(self, tr = None):
+        """Drop trial tr (or every trial if tr is not an integer) from the
+        cache. This is called for each assignment through self.w."""
+
+        if self.f is not None and tr is not None:
+            del self.f
+            self.f = None
+            if os.path.exists(self.fname):
+                os.remove(self.fname)
+        if isinstance(tr, (int, np.integer)):
+            x = self.cache.pop(int(tr) % self.T, None)
+            if x is not None:
+                self.cacheUsed -= x.nbytes
+        else:
+            self.cache.clear()
+            self.cacheUsed = 0
+
+    def _evict(self, nbytes):
+        """Drop the least recently used trials until nbytes more fit."""
+
+        while self.cache and self.cacheUsed + nbytes > self.cacheSize:
+            tr, x = self.cache.popitem(last = False)
+            self.cacheUsed -= x.nbytes
+
+    def _trial(self, tr):
+        """Return the decoded (C, S) array of trial tr, from the cache if
+        possible. The array is shared and must not be modified."""
+
+        tr = int(tr) % self.T
+        x = self.cache.get(tr)
+        if x is not None:
+            self.hits += 1
+            self.cache.move_to_end(tr)
+            return x
+        self.misses += 1
+        x = self._decode(self.m[tr], self.r.chanGain, False, None, None)
+        x.flags.writeable = False
+        if x.nbytes <= self.cacheSize:
+            self._evict(x.nbytes)
+            self.cache[tr] = x
+            self.cacheUsed += x.nbytes
+        return x
+
+    def _scaled(self, tr, ch):
+        """Return the scaled samples of channels ch of trial tr, shaped like
+        self.m[tr, ch], from the sidecar or the cache. Channels that are not
+        in the sidecar are decoded from the .meg4 file. The array must not
+        be modified."""
+
+        if self.f is None:
+            return self._trial(tr)[ch]
+        pos = self.fpos[ch]
+        if np.ndim(pos) == 0:
+            if pos >= 0:
+                return self.f[tr, pos]
+            return self._decode(self.m[tr, ch], self.r.chanGain[ch], False, None, None)
+        if len(pos) and pos.min() >= 0:
+            if np.all(np.diff(pos) == 1):
+                return self.f[tr, pos[0] : pos[-1] + 1]
+            return self.f[tr, pos]
+        ch = np.arange(self.C)[ch]
+        exact = pos < 0
+        x = np.empty((len(ch), self.S))
+        x[exact] = self._decode(self.m[tr, ch[exact]], self.r.chanGain[ch[exact]],
+                                False, None, None)
+        x[~exact] = self.f[tr, pos[~exact]]
+        return x
+
+    def _get(self, tr, ch, start, n, demean, dtype, out):
+        """Return samples start:start+n of channels ch of trial tr, scaled,
+        into out or a new array of type dtype, see _decode()."""
+
+        if self.f is None and self.cacheSize == 0:
+            a = self.m[tr, ch, start : start + n]
+            return self._decode(a, self.r.chanGain[ch], demean, dtype, out)
+        x = self._scaled(tr, ch)[..., start : start + n]
+        if out is None:
+            if (self.f is not None and not demean and dtype is not None and
+                    np.dtype(dtype) == np.float32 and x.dtype == np.float32):
+                return x
+            out = np.array(x, dtype = dtype or self.dtype)
+        elif out.shape != x.shape:
+            raise ValueError("out has shape %s, expected %s" % (out.shape, x.shape))
+        else:
+            out[...] = x
+        if demean:
+            out -= out.mean(axis = -1, keepdims = True)
+        return out
+
+    def _decode(self, a, gain, demean, dtype, out):
+        """Scale the raw (big-endian) samples a by gain, directly into out
+        if given, otherwise into a new array of type dtype (default
+        self.dtype). If demean is true, remove the mean along the last axis."""
 
-    def getRawSegment(self, tr, ch, start = 0, n = 0):
+        a = a.view('>i4')
+        if out is None:
+            out = np.empty(a.shape, dtype = dtype or self.dtype)
+        elif out.shape != a.shape:
+            raise ValueError("out has shape %s, expected %s" % (out.shape, a.shape))
+        np.multiply(a, gain, out = out)
+        if demean:
+            out -= out.mean(axis = -1, keepdims = True)
+        return out
+
+    def getRawSegment(self, tr, ch, start = 0, n = 0, dtype = None, out = None):
         """Read a segment of data from trial tr channel ch."""
 
         if n == 0:
             n = self.r.numSamples
-        a = self.m[tr, ch, start : start + n]
-        s = a.byteswap() * self.r.chanGain[ch]
-        return s
+        return self._get(tr, ch, start, n, False, dtype, out)
 
-    def getSegment(self, tr, ch, start = 0, n = 0):
+    def getSegment(self, tr, ch, start = 0, n = 0, dtype = None, out = None):
         """Read a segment of MEG data from trial tr channel ch. Return a
         numpy array with units of Tesla. The mean is removed."""
 
         if n == 0:
             n = self.r.numSamples
-        a = self.m[tr, ch, start : start + n]
-        s = a.byteswap() * self.r.chanGain[ch]
-        return s - s.mean()
+        return self._get(tr, ch, start, n, True, dtype, out)
 
-    def getArray(self, tr, ch, nch, start, n):
+    def getArray(self, tr, ch, nch, start, n, dtype = None, out = None):
         """Return an array of data from channels ch:ch+nch of trial tr. The
         mean is removed from each channel."""
 
-        a = self.m[tr, ch : ch + nch, start : start + n]
-        s = a.byteswap() * self.r.chanGain[ch : ch + nch]
-        sm = s.mean(axis = 1)
-        sm.shape += (1,)    # make it a column array
-        return s - sm
+        return self._get(tr, slice(ch, ch + nch), start, n, True, dtype, out)
 
-    def getRefArray(self, tr, start = 0, n = 0):
+    def getRefArray(self, tr, start = 0, n = 0, dtype = None, out = None):
         """Return an array of data from all reference channels of trial tr."""
 
         ch = self.r.firstRef
         nch = self.r.numRefs
         if n == 0:
             n = self.r.numSamples
-        return self.getArray(tr, ch, nch, start, n)
+        return self.getArray(tr, ch, nch, start, n, dtype, out)
 
-    def getPriArray(self, tr, start = 0, n = 0):
+    def getPriArray(self, tr, start = 0, n = 0, dtype = None, out = None):
         """Return an array of data from all primary channels of trial tr."""
 
         ch = self.r.firstPrimary
         nch = self.r.numPrimaries
         if n == 0:
             n = self.r.numSamples
-        return self.getArray(tr, ch, nch, start, n)
+        return self.getArray(tr, ch, nch, start, n, dtype, out)
 
-    def getIdxArray(self, tr, idx, start = 0, n = 0):
+    def getIdxArray(self, tr, idx, start = 0, n = 0, dtype = None, out = None):
         """Return an array of data from channels [idx] of trial tr. The
         mean is removed from each channel."""
 
         if n == 0:
             n = self.r.numSamples
-        a = self.m[tr, idx, start : start + n]
-        s = a.byteswap() * self.r.chanGain[idx]
-        sm = s.mean(axis = 1)
-        sm.shape += (1,)    # make it a column array
-        return s - sm
+        return self._get(tr, idx, start, n, True, dtype, out)
+
+    def getEpochs(self, trials, starts, idx, n, dtype = None, out = None):
+        """Return an array of data from channels [idx] for many segments at
+        once, shaped (segments, channels, samples). Segment k is n samples
+        long and starts at sample starts[k] of trial trials[k]. The mean is
+        removed from each channel of each segment. Reads are grouped by
+        trial and sorted by start, so the file is walked in order."""
+
+        trials = np.asarray(trials, dtype = int).ravel()
+        starts = np.asarray(starts, dtype = int).ravel()
+        if trials.shape != starts.shape:
+            raise ValueError("trials and starts must have the same length")
+        if idx is None:
+            idx = np.arange(self.C)
+        idx = np.asarray(idx, dtype = int).ravel()
+        N = len(trials)
+
+        # A segment may run off the end of its trial into the next one, as
+        # long as it stays inside the recording. Normalize to (tr, s) with
+        # 0 <= s < S; segments with s + n > S are read with getSpan().
+
+        absolute = trials * self.S + starts
+        if N > 0 and (trials.min() < 0 or absolute.min() < 0 or
+                      absolute.max() + n > self.T * self.S):
+            raise ValueError("segment out of bounds")
+        trials, starts = np.divmod(absolute, self.S)
+        cross = starts + n > self.S
+
+        cached = self.f is not None or self.cacheSize > 0
+        if cached:
+            if out is None:
+                out = np.empty((N, len(idx), n), dtype = dtype or self.dtype)
+            elif out.shape != (N, len(idx), n):
+                raise ValueError("out has shape %s, expected %s" % (out.shape, (N, len(idx), n)))
+            a = out
+        else:
+            a = np.empty((N, len(idx), n), dtype = 'int32')
+
+        # Sort by trial and start, then gather each trial's segments in
+        # one fancy index. The (channels, segments, samples) gather order
+        # follows the (channels, samples) layout of a trial in the file.
+
+        order = np.lexsort((starts, trials))
+        order = order[~cross[order]]
+        bounds = np.flatnonzero(np.diff(trials[order])) + 1
+        w = np.arange(n)
+        for seg in np.split(order, bounds):
+            if len(seg) == 0:
+                continue
+            cols = starts[seg, None] + w
+            if cached:
+                x = self._scaled(trials[seg[0]], idx)[:, cols]
+            else:
+                x = self.m[trials[seg[0]]][idx[:, None, None], cols[None, :, :]]
+            a[seg] = x.swapaxes(0, 1)
+
+        if not cached:
+            out = self._decode(a, self.r.chanGain[idx], False, dtype, out)
+        for k in np.flatnonzero(cross):
+            self.getSpan(idx, absolute[k], n, out = out[k])
+        out -= out.mean(axis = 2, keepdims = True)
+        return out
+
+    def getSpan(self, idx, start, n, dtype = None, out = None):
+        """Return n samples from channels [idx] (default all), starting at
+        absolute sample start. The trials are taken to be back to back, so
+        absolute sample tr * S + s is sample s of trial tr, and the span
+        may cross trial boundaries. The mean is not removed."""
+
+        if idx is None:
+            idx = np.arange(self.C)
+        idx = np.asarray(idx, dtype = int).ravel()
+        if start < 0 or start + n > self.T * self.S:
+            raise ValueError("span out of bounds")
+        if out is None:
+            out = np.empty((len(idx), n), dtype = dtype or self.dtype)
+        elif out.shape != (len(idx), n):
+            raise ValueError("out has shape %s, expected %s" % (out.shape, (len(idx), n)))
+
+        # Copy the piece from each trial the span touches.
+
+        k = 0
+        while k < n:
+            tr, s = divmod(start + k, self.S)
+            m = min(self.S - s, n - k)
+            self._get(tr, idx, s, m, False, None, out[:, k : k + m])
+            k += m
+        return out
+
+    # Writing. Data are given in the units returned by the getters.
+
+    def _put(self, tr, ch, start, x, flush):
+        """Write the (..., n) array x to samples start:start+n of channels
+        ch of trial tr."""
+
+        self.w.map               # open it now, to find out if we can write
+        if self.readonly:
+            raise PermissionError(".meg4 file is read-only")
+        x = np.asarray(x)
+        n = x.shape[-1]
+        if start < 0 or start + n > self.S:
+            raise ValueError("segment out of bounds")
+        self.w[tr, ch, start : start + n] = encode(x, self.r.chanGain[ch])
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Write any changes in the memmap to the .meg4 file."""
+
+        self.w.flush()
+
+    def putRawSegment(self, tr, ch, x, start = 0, flush = False):
+        """Write the samples x to trial tr channel ch, starting at sample
+        start. The mean is not restored; x is written as is. If flush is
+        true the changes are written to the file now."""
+
+        self._put(tr, ch, start, x, flush)
+
+    def putArray(self, tr, ch, x, start = 0, flush = False):
+        """Write the (nch, n) array x to channels ch:ch+nch of trial tr."""
+
+        self._put(tr, slice(ch, ch + len(x)), start, x, flush)
+
+    def putRefArray(self, tr, x, start = 0, flush = False):
+        """Write an array of data to all reference channels of trial tr."""
+
+        if len(x) != self.r.numRefs:
+            raise ValueError("expected %d reference channels" % self.r.numRefs)
+        self.putArray(tr, self.r.firstRef, x, start, flush)
+
+    def putPriArray(self, tr, x, start = 0, flush = False):
+        """Write an array of data to all primary channels of trial tr."""
+
+        if len(x) != self.r.numPrimaries:
+            raise ValueError("expected %d primary channels" % self.r.numPrimaries)
+        self.putArray(tr, self.r.firstPrimary, x, start, flush)
+
+    def putIdxArray(self, tr, idx, x, start = 0, flush = False):
+        """Write the array x to channels [idx] of trial tr."""
+
+        self._put(tr, idx, start, x, flush)
+
+    def putTrial(self, tr, x, flush = False):
+        """Write a whole (C, S) trial."""
+
+        self._put(tr, slice(None), 0, x, flush)
 
 #    def getArray(self, tr, ch, nch, start, n):
 #        """Return an array of data from channels ch:ch+nch of trial tr. The
 #        mean is removed from each channel."""
 #
 #        return self.getIdxArray(tr, range(ch, ch + nch), start, n)
+
+class contView(object):
+    """A view of a dataset as one continuous recording. CTF stores
+    continuous data as back to back trials, so the (T, C, S) data are
+    seen here as a (C, T * S) array, where absolute sample tr * S + s is
+    sample s of trial tr. Index it like an array,
+
+        v[idx, 1000:2000]       channels [idx], samples 1000 to 1999
+        v[3, 1000:2000]         one channel, as a 1-d array
+        v[1000:2000]            all channels
+
+    Only the samples asked for are read. The mean is not removed. Times
+    are in seconds from the start of the recording."""
+
+    def __init__(self, d, srate):
+        self.d = d
+        self.srate = srate
+        self.shape = (d.C, d.T * d.S)
+
+    def __len__(self):
+        return self.shape[1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (slice(None), key)
+        if len(key) != 2:
+            raise IndexError("expected [channels, samples]")
+        ch, samp = key
+
+        one = isinstance(ch, (int, np.integer))
+        if isinstance(ch, slice):
+            idx = np.arange(self.shape[0])[ch]
+        else:
+            idx = np.asarray(ch, dtype = int).ravel()
+            idx = np.where(idx < 0, idx + self.shape[0], idx)
+
+        if isinstance(samp, slice):
+            start, stop, step = samp.indices(self.shape[1])
+            if step < 0:
+                raise IndexError("negative sample steps are not supported")
+            x = self.d.getSpan(idx, start, max(stop - start, 0))
+            if step != 1:
+                x = x[:, ::step]
+        else:
+            s = int(samp)
+            if s < 0:
+                s += self.shape[1]
+            x = self.d.getSpan(idx, s, 1)[:, 0]
+        return x[0] if one else x
+
+    def sampleNo(self, t):
+        """Convert a time in seconds to an absolute sample number."""
+
+        return int(np.floor(t * self.srate + .5))
+
+    def timePt(self, samp):
+        """Convert an absolute sample number to a time in seconds."""
+
+        return samp / self.srate
+
+    def window(self, t0, t1, idx = None, dtype = None):
+        """Return the data from channels [idx] (default all) between times
+        t0 and t1, as a (channels, samples) array."""
+
+        s0 = self.sampleNo(t0)
+        n = int((t1 - t0) * self.srate + .5)
+        return self.d.getSpan(idx, s0, n, dtype)
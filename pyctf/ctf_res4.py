@@ -1,4 +1,4 @@
-from struct import Struct
+from struct import Struct, error as StructError
 import numpy as np
 
 # Various structs in a .res4 file
@@ -109,6 +109,34 @@ CoeffInfo = Struct(""">
  ci_coeff
 ) = range(5)
 
+# The same records as numpy structured dtypes, for decoding whole sections
+# at once. Note that numpy strips trailing '\x00' bytes from strings.
+
+SensorResDtype = np.dtype([
+    ('type', '>i2'), ('runNum', '>i2'), ('shape', '>i4'),
+    ('properGain', '>f8'), ('qGain', '>f8'), ('ioGain', '>f8'), ('ioOffset', '>f8'),
+    ('numCoils', '>i2'), ('gradOrder', '>i2'), ('stimPol', '>i4')])
+
+CoilRecDtype = np.dtype({
+    'names': ['x', 'y', 'z', 'nx', 'ny', 'nz', 'nturns', 'area'],
+    'formats': ['>f8'] * 6 + ['>i2', '>f8'],
+    'offsets': [0, 8, 16, 32, 40, 48, 64, 72],
+    'itemsize': CoilRec.size})
+
+# One channel's SensorRes followed by its dewar and head coil records.
+
+SensorDtype = np.dtype([
+    ('sr', SensorResDtype),
+    ('dewar', CoilRecDtype, (MAX_COILS,)),
+    ('head', CoilRecDtype, (MAX_COILS,))])
+
+CoeffInfoDtype = np.dtype({
+    'names': ['sensorName', 'type', 'ncoeff', 'sensorList', 'coeff'],
+    'formats': ['S32', 'S4', '>i2', 'S%d' % (MAX_BALANCING * SENSOR_LABEL),
+                ('>f8', (MAX_BALANCING,))],
+    'offsets': [0, 32, 40, 42, 42 + MAX_BALANCING * SENSOR_LABEL],
+    'itemsize': CoeffInfo.size})
+
 # Strings returned by Struct.unpack() include '\x00' bytes at the end.
 
 def nullstrip(s):
@@ -134,52 +162,63 @@ def putstruct(f, s, vl):
 class res4data:
     pass
 
-def read_res4_structs(res4name):
-    """Low level .res4 file access."""
+def _parseHeader(buf):
+    """Parse the start of a .res4 file in buf, up to the sensor records.
+    Returns (genRes, runDesc, filterInfo, chanName, off), where off is
+    the offset of the sensor records."""
 
-    f = open(res4name, 'rb')
-    s = f.read(8)
-    if s[:-1] != RES41HDR and s[:-1] != RES42HDR:
+    if buf[:7] != RES41HDR and buf[:7] != RES42HDR:
         raise RuntimeError("invalid .res4 file")
+    off = 8
 
-    gr = getstruct(f, GenRes)
-    runDesc = nullstrip(f.read(gr[gr_rdlen]))
+    gr = GenRes.unpack_from(buf, off)
+    off += GenRes.size
+    runDesc = nullstrip(buf[off : off + gr[gr_rdlen]])
+    off += gr[gr_rdlen]
 
-    nf = getstruct(f, NumFilters)[0]
+    nf = NumFilters.unpack_from(buf, off)[0]
+    off += NumFilters.size
     filterInfo = [None] * nf
     for i in range(nf):
-        fi = getstruct(f, FilterInfo)
+        fi = FilterInfo.unpack_from(buf, off)
+        off += FilterInfo.size
         n = fi[fi_nparam]
-        fp = [None] * n
-        for j in range(n):
-            fp[j] = getstruct(f, FilterParam)
+        fp = list(FilterParam.iter_unpack(buf[off : off + n * FilterParam.size]))
+        off += n * FilterParam.size
         filterInfo[i] = (fi, fp)
 
     M = gr[gr_numChannels]
-    chanName = [None] * M
-    for i in range(M):
-        s = getstruct(f, ChannelName)
-        chanName[i] = nullstrip(s[0])
+    names = np.frombuffer(buf, 'S32', M, off)
+    off += M * ChannelName.size
+    chanName = [nullstrip(s) for s in names.tolist()]
 
-    sensRes = [None] * M
-    for i in range(M):
-        sr = getstruct(f, SensorRes)
-        crd = [None] * MAX_COILS
-        crh = [None] * MAX_COILS
-        # dewar coords
-        for j in range(MAX_COILS):
-            crd[j] = getstruct(f, CoilRec)
-        # head coords
-        for j in range(MAX_COILS):
-            crh[j] = getstruct(f, CoilRec)
-        sensRes[i] = (sr, crd, crh)
+    return gr, runDesc, filterInfo, chanName, off
 
-    n = getstruct(f, NumCoeffs)[0]
-    coeffInfo = [None] * n
-    for i in range(n):
-        coeffInfo[i] = getstruct(f, CoeffInfo)
+def read_res4_structs(res4name):
+    """Low level .res4 file access. The whole file is read at once, and
+    the channel and coefficient sections are decoded with numpy structured
+    dtypes. Besides the raw structs (as tuples), the returned container
+    has r.sensArray, a SensorDtype array with one element per channel, and
+    r.coeffArray, a CoeffInfoDtype array."""
+
+    with open(res4name, 'rb') as f:
+        buf = f.read()
+    gr, runDesc, filterInfo, chanName, off = _parseHeader(buf)
+    M = gr[gr_numChannels]
 
-    f.close()
+    sens = np.frombuffer(buf, SensorDtype, M, off)
+    off += M * SensorDtype.itemsize
+    sensRes = list(zip(sens['sr'].tolist(), sens['dewar'].tolist(),
+                       sens['head'].tolist()))
+
+    n = NumCoeffs.unpack_from(buf, off)[0]
+    off += NumCoeffs.size
+    coeff = np.frombuffer(buf, CoeffInfoDtype, n, off)
+
+    # The tuples keep the '\x00' padding of the names, so they are unpacked
+    # with the struct rather than rebuilt from the array.
+
+    coeffInfo = list(CoeffInfo.iter_unpack(buf[off : off + n * CoeffInfo.size]))
 
     # Collect everything into a res4data container.
 
@@ -190,6 +229,8 @@ def read_res4_structs(res4name):
     r.chanName = chanName
     r.sensRes = sensRes
     r.coeffInfo = coeffInfo
+    r.sensArray = sens
+    r.coeffArray = coeff
 
     return r
 
@@ -209,7 +250,8 @@ def write_res4_structs(res4name, r):
         putstruct(f, FilterInfo, fi)
         n = fi[fi_nparam]
         for j in range(n):
-            putstruct(f, FilterParam, [fp[j]])
+            x = fp[j]           # a 1-tuple, as read, or a number
+            putstruct(f, FilterParam, x if isinstance(x, tuple) else [x])
 
     M = r.genRes[gr_numChannels]
     for i in range(M):
@@ -230,12 +272,134 @@ def write_res4_structs(res4name, r):
 
     f.close()
 
+# Read just the header information of a res4 file. FILTER_ROOM bytes are
+# read for the filter section at first, enough for the usual few filters.
+
+FILTER_ROOM = 4096
+
+def readRes4Header(res4name):
+    """Read the general information and the channel names and types from
+    a .res4 file, without reading the coefficient records or decoding the
+    sensor records. This is much cheaper than readRes4() when scanning
+    many datasets. The returned container has genRes, runDesc, numTrials,
+    numChannels, numSamples, sampleRate, time, date, runName, chanFname,
+    and chanType (a numpy array)."""
+
+    # The general information gives the size of everything up to the end
+    # of the sensor records, except the (short) filter section. Read that
+    # much, plus some room for the filters; read the rest of the file only
+    # if the filters don't fit.
+
+    with open(res4name, 'rb') as f:
+        buf = f.read(8 + GenRes.size)
+        try:
+            gr = GenRes.unpack_from(buf, 8)
+        except StructError:
+            raise RuntimeError("truncated .res4 file") from None
+        M = gr[gr_numChannels]
+        buf += f.read(gr[gr_rdlen] + NumFilters.size + FILTER_ROOM +
+                      M * (ChannelName.size + SensorDtype.itemsize))
+        try:
+            gr, runDesc, filterInfo, chanName, off = _parseHeader(buf)
+        except (StructError, ValueError):
+            buf += f.read()
+            try:
+                gr, runDesc, filterInfo, chanName, off = _parseHeader(buf)
+            except (StructError, ValueError):
+                raise RuntimeError("truncated .res4 file") from None
+        need = off + M * SensorDtype.itemsize
+        if len(buf) < need:
+            buf += f.read(need - len(buf))
+
+    # Only the type field of each channel's sensor record is needed.
+
+    try:
+        sens = np.frombuffer(buf, SensorDtype, M, off)
+    except ValueError:
+        raise RuntimeError("truncated .res4 file") from None
+
+    r = res4data()
+    r.genRes = gr
+    r.runDesc = runDesc
+    r.numTrials = gr[gr_numTrials]
+    r.numChannels = M
+    r.numSamples = gr[gr_numSamples]
+    r.sampleRate = gr[gr_sampleRate]
+    r.time = nullstrip(gr[gr_time]).decode("utf-8")
+    r.date = nullstrip(gr[gr_date]).decode("utf-8")
+    r.runName = nullstrip(gr[gr_runName]).decode("utf-8", "replace")
+    r.chanFname = [fmtChanName(x) for x in chanName]
+    r.chanType = sens['sr']['type'].astype(int)
+    return r
+
 # Format channel names to make them more user friendly.
 
 def fmtChanName(name):
     """Remove the -xxxx from a channel name."""
     return name.decode("utf-8").split('-')[0]
 
+# Columnar channel information, for fast channel selection.
+
+class chanTable:
+    """Channel information stored as numpy arrays indexed by channel
+    number, with per-type index arrays and a sorted name index.
+        t.name          Array of formatted channel names.
+        t.type          Channel types.
+        t.gain          Channel gains.
+        t.gradOrder     Gradient order applied to each channel.
+        t.numCoils      Number of coils of each channel.
+        t.byType        Mapping from type to an array of channel numbers.
+    """
+
+    def __init__(self, r):
+        sr = r.sensArray['sr']
+        self.name = np.array(r.chanFname)
+        self.type = sr['type'].astype(int)
+        self.gain = r.chanGain[:, 0]
+        self.gradOrder = sr['gradOrder'].astype(int)
+        self.numCoils = sr['numCoils'].astype(int)
+        self.byType = {int(t): np.flatnonzero(self.type == t)
+                       for t in np.unique(self.type)}
+
+        # Sorted names, with room for one more character (see prefix()).
+
+        w = max([len(x) for x in r.chanFname] + [1]) + 1
+        self.order = np.argsort(self.name, kind = 'stable')
+        self.sorted = self.name[self.order].astype('<U%d' % w)
+
+    def ofType(self, cls):
+        """Return the channel numbers of type cls, in channel order."""
+
+        return self.byType.get(cls, np.zeros(0, dtype = int))
+
+    def prefix(self, p):
+        """Return the channel numbers whose names start with p, in channel
+        order."""
+
+        lo = np.searchsorted(self.sorted, p, 'left')
+        hi = np.searchsorted(self.sorted, p + chr(0x10ffff), 'left')
+        return np.sort(self.order[lo:hi])
+
+    def select(self, clist, cls = TYPE_MEG):
+        """Return an array of the channel numbers of type cls (any type if
+        cls is None) whose names start with any of the prefixes in clist.
+        The channels matching each prefix are listed in channel order.
+        Raises ValueError if a prefix matches no channel."""
+
+        if isinstance(clist, str):
+            clist = [clist]
+        l = []
+        for c in clist:
+            i = self.prefix(c)
+            if cls is not None:
+                i = i[self.type[i] == cls]
+            if len(i) == 0:
+                raise ValueError("channel %s not found" % c)
+            l.append(i)
+        if not l:
+            return np.zeros(0, dtype = int)
+        return np.concatenate(l)
+
 # Read a .res4 file and format the info to be more usable.
 
 def readRes4(res4name):
@@ -255,6 +419,13 @@ def readRes4(res4name):
         r.firstRef      Index of first reference channel.
         r.numRefs       Number of reference channels.
         r.coeff         Re-formatted balancing coefficients.
+        r.chanTable     Columnar channel information, see chanTable.
+        r.coilPos       (channels, MAX_COILS, 3) coil positions, and
+        r.coilNormal    normals, in dewar coordinates (cm). Unused
+                        coils are zero.
+        r.coilTurns     (channels, MAX_COILS) number of turns, and
+        r.coilArea      coil areas.
+        r.numCoils      Number of coils of each channel.
 
         r.genRes        raw GenRes struct
         r.runDesc       run description
@@ -286,30 +457,30 @@ def readRes4(res4name):
 
     # Channel types.
 
-    r.firstPrimary = None
-    r.numPrimaries = 0
-    r.firstRef = None
-    r.numRefs = 0
+    types = r.sensArray['sr']['type']
+    r.chanType = types.tolist()
+    pri = np.flatnonzero(types == TYPE_MEG)
+    ref = np.flatnonzero((types == TYPE_REF_MAG) | (types == TYPE_REF_GRAD))
+    r.firstPrimary = int(pri[0]) if len(pri) else None
+    r.numPrimaries = len(pri)
+    r.firstRef = int(ref[0]) if len(ref) else None
+    r.numRefs = len(ref)
 
-    r.chanType = [None] * M
+    # A column array of channel gains.
 
-    for i in range(M):
-        r.chanType[i] = r.sensRes[i][0][sr_type]
-        if r.chanType[i] == TYPE_MEG:
-            if r.firstPrimary is None:
-                r.firstPrimary = i
-            r.numPrimaries += 1
-        elif r.chanType[i] == TYPE_REF_MAG or r.chanType[i] == TYPE_REF_GRAD:
-            if r.firstRef is None:
-                r.firstRef = i
-            r.numRefs += 1
+    sr = r.sensArray['sr']
+    r.chanGain = (1. / (sr['properGain'] * sr['qGain'] * sr['ioGain'])).reshape((M, 1))
 
-    # A column array of channel gains.
+    r.chanTable = chanTable(r)
 
-    r.chanGain = np.zeros((M, 1))
-    for i in range(M):
-        sr = r.sensRes[i][0]
-        r.chanGain[i] = 1. / (sr[sr_properGain] * sr[sr_qGain] * sr[sr_ioGain])
+    # Coil geometry, as native arrays.
+
+    coil = r.sensArray['dewar']
+    r.coilPos = np.stack((coil['x'], coil['y'], coil['z']), axis = -1).astype('d')
+    r.coilNormal = np.stack((coil['nx'], coil['ny'], coil['nz']), axis = -1).astype('d')
+    r.coilTurns = coil['nturns'].astype(int)
+    r.coilArea = coil['area'].astype('d')
+    r.numCoils = sr['numCoils'].astype(int)
 
     # Balancing coefficients. Don't bother if there are no references.
 
@@ -331,7 +502,24 @@ def readRes4(res4name):
             cidx = r.chanIndex[cn]
             cl[j] = (cn, cidx, ci[ci_coeff + j])
         ci[ci_sensorList] = cl
-        # ...
-        #r.__dict__['G3BR'] = refvec
+
+    # The balancing matrices are constructed by balance.balanceMatrix().
 
     return r
+
+if __name__ == '__main__':
+    # Round trip check: python -m pyctf.ctf_res4 file.res4
+    import sys, os, tempfile
+
+    r = read_res4_structs(sys.argv[1])
+    fd, tmp = tempfile.mkstemp(suffix = '.res4')
+    os.close(fd)
+    try:
+        write_res4_structs(tmp, r)
+        r2 = read_res4_structs(tmp)
+    finally:
+        os.remove(tmp)
+    for k in ('genRes', 'runDesc', 'filterInfo', 'chanName', 'sensRes', 'coeffInfo'):
+        print(k, 'ok' if getattr(r, k) == getattr(r2, k) else 'DIFFERENT')
+    print('sensArray', 'ok' if r.sensArray.tobytes() == r2.sensArray.tobytes() else 'DIFFERENT')
+    print('coeffArray', 'ok' if r.coeffArray.tobytes() == r2.coeffArray.tobytes() else 'DIFFERENT')
@@ -1,22 +1,53 @@
 """This is the main interface for the Python CTF library."""
 
 import sys, os, math
+import hashlib
+import numpy as np
 from . import ctf_res4 as ctf
-from .ctf_meg4 import dsData
+from .ctf_meg4 import dsData, contView, meg4Parts
 from .markers import markers
+from .classfileFunc import classes
 from .getHC import getHC
-from .getHM import getHM
+from .getHM import getHM, getHMTimeline, getHMSummary
+from .triggers import findTriggers, writeTriggers
 from . import fid
+from . import balance
 
 class dsopen:
 
-    def __init__(self, dsname):
+    # With lazy = True, these attributes are computed on first use by the
+    # named methods.
+
+    lazyattrs = {'dsData': '_openData', 'marks': '_readMarks',
+                 'dewar': '_readHC', 'head': '_readHC', 'dewar_to_head': '_readHC',
+                 'cont': '_makeCont', 'classes': '_readClasses'}
+
+    def __init__(self, dsname, cache = 0, sidecar = False, cachedir = None,
+                 lazy = False):
         """Create and return an open CTF dataset object.
         You may open many CTF datasets at once by creating many
         instances of this class. You must call close() or
-        delete the instance to release any array memory held."""
-
-        self.dsData = None      # set this now so __del__ won't complain
+        delete the instance to release any array memory held.
+        If cache is nonzero, up to that many bytes of decoded
+        trials are kept in memory for repeated reads.
+
+        A float32 sidecar file holding the decoded data (see
+        sidecarName()) is used automatically whenever it is newer
+        than the .meg4 and .res4 files. If sidecar is true, one is
+        created first if needed. Sidecars are kept in the dataset
+        directory unless cachedir is given. The sidecar only holds
+        the MEG and reference channels, and only to float32
+        precision (about 7 significant digits); the other channels,
+        such as triggers, are always read exactly from the .meg4
+        file. Reads still return float64 arrays unless dtype is
+        numpy.float32, see ctf_meg4.dsData.useSidecar().
+
+        If lazy is true only the .res4 file is read now; the data,
+        markers and head coil positions are read on first use."""
+
+        self.loaded = set()     # lazy attribute loaders already run
+        self.bmat = {}          # balancing matrices, by gradient order
+        self.geom = None        # head frame coil geometry
 
         dsname = os.path.expanduser(dsname)
         if dsname[-1] == '/':
@@ -26,28 +57,71 @@ class dsopen:
             raise ValueError("%s is not a dataset name" % dsname)
         self.dsname = dsname
         self.setname = b[:-3]
+        self.opts = (cache, sidecar, cachedir)
 
         # Open files. We allow the .meg4 file to be absent.
 
-        meg4name = self.getDsFileNameExt('.meg4')
         res4name = self.getDsFileNameExt('.res4')
         self.r = ctf.readRes4(res4name)
+
+        # A mapping from channel name to number, backwards compatible name.
+
+        self.channel = self.r.chanIndex
+
+        if not lazy:
+            for name in ('_openData', '_readMarks', '_readHC'):
+                self._load(name)
+
+    def __getattr__(self, name):
+        # Only called for missing attributes; run the lazy loader, once.
+        loader = dsopen.lazyattrs.get(name)
+        loaded = self.__dict__.get('loaded')
+        if loader is None or loaded is None or loader in loaded:
+            raise AttributeError(name)
+        self._load(loader)
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def _load(self, loader):
+        self.loaded.add(loader)
+        getattr(self, loader)()
+
+    def _openData(self):
+        """Map the .meg4 file."""
+
+        self.dsData = None
+        cache, sidecar, cachedir = self.opts
+        meg4name = self.getDsFileNameExt('.meg4')
         try:
-            self.dsData = dsData(self.r, meg4name)  # handle to open .meg4 file (mmap)
+            self.dsData = dsData(self.r, meg4name, cache)  # handle to open .meg4 file (mmap)
         except FileNotFoundError as e:
             print("[pyctf] Note: {}".format(e), file = sys.stderr)
         except ValueError as e:
             print("[pyctf] Note: {}".format(e), file = sys.stderr)
+        if self.dsData is not None:
+            self.openSidecar(sidecar, cachedir)
 
-        # A mapping from channel name to number, backwards compatible name.
+    def _makeCont(self):
+        """Make the continuous view of the data, self.cont (see contView)."""
 
-        self.channel = self.r.chanIndex
+        self.cont = None
+        if self.dsData is not None:
+            self.cont = contView(self.dsData, self.getSampleRate())
+
+    def _readMarks(self):
+        """Get the marks, if any."""
+
+        self.marks = markers(self.dsname)
 
-        # Get the marks, if any.
+    def _readClasses(self):
+        """Get the trial classes, if any (see classfileFunc.classes)."""
 
-        self.marks = markers(dsname)
+        self.classes = classes(self.dsname)
 
-        # Get the dewar coordinates of the head from the .hc file, if any.
+    def _readHC(self):
+        """Get the dewar coordinates of the head from the .hc file, if any."""
 
         hc = self.getDsFileNameExt('.hc')
         try:
@@ -66,15 +140,54 @@ class dsopen:
 
     def __del__(self):
         # deletion takes down everything
-        del self.dsData
+        self.__dict__.pop('cont', None)
+        self.__dict__.pop('dsData', None)
 
     def close(self):
         """close() releases dataset memory but does not delete
         the .r or other ds. objects."""
         # just close the dsData object to release memory
-        if self.dsData is not None:
+        if self.__dict__.get('dsData') is not None:
             self.dsData.close()
-            self.dsData = None
+        self.loaded.add('_openData')
+        self.dsData = None
+        self.__dict__.pop('cont', None)
+        self.loaded.discard('_makeCont')
+
+    def sidecarName(self, cachedir = None):
+        """Return the name of the float32 sidecar file of this dataset.
+        In a shared cachedir the name includes a hash of the dataset path."""
+
+        if cachedir is None:
+            return self.getDsFileNameExt('.f32')
+        h = hashlib.sha1(os.path.abspath(self.dsname).encode()).hexdigest()
+        name = "%s-%s.f32" % (self.setname, h[:12])
+        return os.path.join(os.path.expanduser(cachedir), name)
+
+    def openSidecar(self, create = False, cachedir = None):
+        """Read the data from the float32 sidecar if it is up to date,
+        creating it first if create is true. Returns True if the sidecar
+        is in use."""
+
+        name = self.sidecarName(cachedir)
+        src = meg4Parts(self.getDsFileNameExt('.meg4'))
+        src.append(self.getDsFileNameExt('.res4'))
+        try:
+            st = os.stat(name)
+            fresh = (st.st_size == self.dsData.sidecarSize() and
+                st.st_mtime >= max(os.path.getmtime(x) for x in src))
+        except FileNotFoundError:
+            fresh = False
+        if not fresh:
+            if not create:
+                return False
+            try:
+                self.dsData.makeSidecar(name)
+            except OSError as e:
+                print("[pyctf] Note: can't create sidecar: {}".format(e), file = sys.stderr)
+                return False
+        self.dsData.useSidecar(name)
+        return True
 
     def getDsFileName(self, name):
         """Formats a pathname for a dataset file."""
@@ -136,12 +249,8 @@ class dsopen:
     def getSensorList(self, cls = ctf.TYPE_MEG):
         """Return a list of the channel names in ds, of type cls."""
 
-        nc = self.r.numChannels
-        l = []
-        for i in range(nc):
-            if self.getChannelType(i) == cls:
-                l.append(self.r.chanFname[i])
-        return l
+        t = self.r.chanTable
+        return t.name[t.ofType(cls)].tolist()
 
     def getPreTrigSamples(self):
         """Return the number of samples in the pre-trigger interval."""
@@ -168,63 +277,193 @@ class dsopen:
     def removeProcessing(self):
         pass
 
-    def getRefArray(self, tr, start = 0, n = 0):
-        """Return an array of data from all reference channels of trial tr."""
-
-        return self.dsData.getRefArray(tr, start, n)
-
-    def getPriArray(self, tr, start = 0, n = 0):
-        """Return an array of data from all primary channels of trial tr."""
-
-        return self.dsData.getPriArray(tr, start, n)
-
-    def getIdxArray(self, tr, idx, start = 0, n = 0):
+    def getRefArray(self, tr, start = 0, n = 0, dtype = None, out = None):
+        """Return an array of data from all reference channels of trial tr.
+        The getters all accept dtype (e.g. numpy.float32) to choose the type
+        of the result, and out to decode into an existing array."""
+
+        return self.dsData.getRefArray(tr, start, n, dtype, out)
+
+    def getPriArray(self, tr, start = 0, n = 0, dtype = None, out = None, grad = None):
+        """Return an array of data from all primary channels of trial tr.
+        If grad is given (1, 2, 3 or 'G1BR', ...) the data are balanced to
+        that gradient order with the reference channels."""
+
+        p = self.dsData.getPriArray(tr, start, n, dtype, out)
+        if grad is not None:
+            ref = self.dsData.getRefArray(tr, start, n, dtype)
+            balance.balance(self.getBalanceMatrix(grad), p, ref)
+        return p
+
+    def getBalanceMatrix(self, grad):
+        """Return the (primaries, references) balancing matrix B that takes
+        the stored primary data to gradient order grad, as pri - B.dot(ref).
+        The matrix is computed once per dataset and order."""
+
+        order = balance._order(grad)
+        B = self.bmat.get(order)
+        if B is None:
+            B = balance.balanceMatrix(self.r, order)
+            self.bmat[order] = B
+        return B
+
+    def getIdxArray(self, tr, idx, start = 0, n = 0, dtype = None, out = None):
         """Return an array of data from channels [idx] of trial tr."""
 
-        return self.dsData.getIdxArray(tr, idx, start, n)
-
-    def getDsRawData(self, tr, ch):
+        return self.dsData.getIdxArray(tr, idx, start, n, dtype, out)
+
+    def getEpochs(self, trials, starts, idx = None, n = 0, dtype = None, out = None):
+        """Return an array of data from channels [idx] (default all) for
+        many segments, shaped (segments, channels, samples). Segment k
+        starts at sample starts[k] of trial trials[k]; n defaults to the
+        whole trial. A segment may run on into the following trial. The
+        mean is removed from each channel of each segment."""
+
+        if n == 0:
+            n = self.r.numSamples
+        return self.dsData.getEpochs(trials, starts, idx, n, dtype, out)
+
+    def getSegmentArray(self, seglist, seglen, idx = None, dtype = None, out = None):
+        """Return the segments of seglist, as returned by get_segment_list(),
+        as one (segments, channels, samples) array."""
+
+        a = np.asarray(seglist, dtype = int).reshape(-1, 2)
+        return self.getEpochs(a[:, 0], a[:, 1], idx, seglen, dtype, out)
+
+    def getSpan(self, idx, start, n, dtype = None, out = None):
+        """Return n samples from channels [idx] (default all) starting at
+        absolute sample start, treating the trials as one continuous
+        recording. The span may cross trial boundaries."""
+
+        return self.dsData.getSpan(idx, start, n, dtype, out)
+
+    def iterChunks(self, idx = None, size = 0, overlap = 0, dtype = None):
+        """Iterate over the whole recording in chunks of size samples
+        (default one trial) from channels [idx] (default all), crossing
+        trial boundaries. Consecutive chunks share overlap samples, which
+        is useful for filtering. Yields (start, array) pairs, where start
+        is the absolute sample number of the first column; the last chunk
+        may be short. Only one chunk is in memory at a time."""
+
+        if size == 0:
+            size = self.r.numSamples
+        if overlap < 0 or overlap >= size:
+            raise ValueError("overlap must be in [0, size)")
+        total = self.r.numTrials * self.r.numSamples
+        start = 0
+        while start < total:
+            n = min(size, total - start)
+            yield start, self.dsData.getSpan(idx, start, n, dtype)
+            if start + n >= total:
+                break
+            start += size - overlap
+
+    def getDsRawData(self, tr, ch, dtype = None, out = None):
         """Return trial tr from channel ch as a numpy array."""
 
-        return self.dsData.getRawSegment(tr, ch)
+        return self.dsData.getRawSegment(tr, ch, dtype = dtype, out = out)
 
-    def getDsData(self, tr, ch):
+    def getDsData(self, tr, ch, dtype = None, out = None):
         """Return trial tr from channel ch, the mean is removed."""
 
-        return self.dsData.getSegment(tr, ch)
+        return self.dsData.getSegment(tr, ch, dtype = dtype, out = out)
 
-    def getDsRawSegment(self, tr, ch, start = 0, n = 0):
+    def getDsRawSegment(self, tr, ch, start = 0, n = 0, dtype = None, out = None):
         """Return n samples starting at start from trial tr channel ch."""
 
-        return self.dsData.getRawSegment(tr, ch, start, n)
+        return self.dsData.getRawSegment(tr, ch, start, n, dtype, out)
 
-    def getDsSegment(self, tr, ch, start = 0, n = 0):
+    def getDsSegment(self, tr, ch, start = 0, n = 0, dtype = None, out = None):
         """Return n samples starting at start from trial tr channel ch, the
         mean is removed."""
 
-        return self.dsData.getSegment(tr, ch, start, n)
+        return self.dsData.getSegment(tr, ch, start, n, dtype, out)
+
+    def putRefArray(self, tr, x, start = 0, flush = False):
+        """Write an array of data to all reference channels of trial tr.
+        The put functions take data in the same units as the getters and
+        write them back into the .meg4 file, in place. If flush is true
+        the changes are written to the file now; see also flush()."""
+
+        self.dsData.putRefArray(tr, x, start, flush)
+
+    def putPriArray(self, tr, x, start = 0, flush = False):
+        """Write an array of data to all primary channels of trial tr."""
+
+        self.dsData.putPriArray(tr, x, start, flush)
+
+    def putIdxArray(self, tr, idx, x, start = 0, flush = False):
+        """Write an array of data to channels [idx] of trial tr."""
+
+        self.dsData.putIdxArray(tr, idx, x, start, flush)
+
+    def putDsRawSegment(self, tr, ch, x, start = 0, flush = False):
+        """Write the samples x to trial tr channel ch, starting at start."""
+
+        self.dsData.putRawSegment(tr, ch, x, start, flush)
+
+    def putTrial(self, tr, x, flush = False):
+        """Write all the channels of trial tr."""
+
+        self.dsData.putTrial(tr, x, flush)
+
+    def flush(self):
+        """Write any changes to the .meg4 file."""
+
+        self.dsData.flush()
 
     def isAverage(self):
         return self.r.genRes[ctf.gr_numAvg] > 0
 
+    def isContinuous(self):
+        """Return True if the trials look like back to back pieces of one
+        continuous recording: the data are not averaged, and the trials
+        have no pre-trigger interval."""
+
+        return not self.isAverage() and self.getPreTrigSamples() == 0
+
     def getHLCData(self, t, chan):
         return getHM(self, t, chan)
 
+    def getCoilGeometry(self):
+        """Return (pos, normal), the coil positions (cm) and normals of
+        every channel in the head frame of the .hc file, each shaped
+        (channels, MAX_COILS, 3); see r.coilPos. Unused coils are zero.
+        The arrays are computed once per dataset."""
+
+        if self.geom is None:
+            m = self.dewar_to_head
+            used = (np.arange(ctf.MAX_COILS) < self.r.numCoils[:, None])[..., None]
+            pos = fid.fid_transform_batch(m, self.r.coilPos) * used
+            normal = fid.fid_rotate_batch(m, self.r.coilNormal) * used
+            self.geom = pos, normal
+        return self.geom
+
+    def getHeadMotion(self, decim = 1, dtype = None):
+        """Return the head coil positions over the whole recording, an
+        (N, 3, 3) array in cm in the head frame, see getHM.getHMTimeline()."""
+
+        return getHMTimeline(self, decim, dtype)
+
+    def getHeadMotionSummary(self, cache = True):
+        """Return the per-trial (maxd, meand) head coil displacements from
+        the .hc positions, see getHM.getHMSummary()."""
+
+        return getHMSummary(self, cache)
+
+    def getTriggers(self, chans = None, mask = None, threshold = None,
+                    cross = False, write = False):
+        """Find the events in the trigger channels, see
+        triggers.findTriggers(). If write is true they are also added to
+        the markers, and MarkerFile.mrk is written."""
+
+        events = findTriggers(self, chans, mask, threshold, cross)
+        if write:
+            writeTriggers(self, events)
+        return events
+
     def clist2idx(self, clist, cls = ctf.TYPE_MEG):
-        """Convert a list of channel names to indices. Allow prefixes."""
-
-        nc = self.r.numChannels
-        chanName = self.r.chanFname
-        chanType = self.r.chanType
-        sl = [(i, chanName[i]) for i in range(nc) if chanType[i] == cls]
-        r = []
-        for c in clist:
-            n = len(c)
-            found = False
-            for i, s in sl:
-                if c == s[0:n]:
-                    r.append(i)
-                    found = True
-            if not found:
-                raise ValueError("channel %s not found" % c)
-        return r
+        """Convert a list of channel names to indices. Allow prefixes.
+        If cls is None, channels of any type match."""
+
+        return self.r.chanTable.select(clist, cls).tolist()
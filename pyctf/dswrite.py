@@ -0,0 +1,171 @@
+# Write new datasets, either from scratch (using an existing .res4 as a
+# template) or as channel and/or trial subsets of an existing dataset.
+# The .meg4 file is streamed one trial at a time.
+
+import os, shutil
+import numpy as np
+from . import ctf_res4 as ctf
+from .ctf_meg4 import MEG4HDR, encode
+from .markers import markers
+
+__all__ = ['dsWriter', 'dsSubset', 'subsetRes4']
+
+# CTF splits the .meg4 file so that no part is larger than this.
+
+MAX_MEG4 = 2**31 - 1
+
+def chanIdx(r, chans):
+    """Convert a list of channel names or numbers into an index array.
+    None means all channels."""
+
+    if chans is None:
+        return np.arange(r.numChannels)
+    return np.array([r.chanIndex[c] if isinstance(c, str) else c
+                     for c in chans], dtype = int)
+
+def subsetRes4(r, idx, ntrials):
+    """Return a res4data container for a dataset with channels [idx] of
+    r and ntrials trials, suitable for write_res4_structs(). Balancing
+    coefficients are kept for channels whose references are all kept.
+    A ValueError is raised if a kept channel has been balanced (its
+    gradient order is not 0) but its references are not all kept, since
+    the new dataset could then not be unbalanced or rebalanced."""
+
+    gr = list(r.genRes)
+    gr[ctf.gr_numChannels] = len(idx)
+    gr[ctf.gr_numTrials] = ntrials
+    gr[ctf.gr_epochTime] = gr[ctf.gr_numSamples] / gr[ctf.gr_sampleRate] * ntrials
+
+    n = ctf.res4data()
+    n.genRes = tuple(gr)
+    n.runDesc = r.runDesc
+    n.filterInfo = r.filterInfo
+    n.chanName = [r.chanName[i] for i in idx]
+    n.sensRes = [r.sensRes[i] for i in idx]
+
+    keep = set(ctf.fmtChanName(c) for c in n.chanName)
+    grad = {ctf.fmtChanName(c): s[0][ctf.sr_gradOrder]
+            for c, s in zip(n.chanName, n.sensRes)}
+    n.coeffInfo = []
+    for ci in r.coeffInfo:
+        name = ctf.fmtChanName(ctf.nullstrip(ci[ctf.ci_sensorName]))
+        if name not in keep:
+            continue
+        sl = ci[ctf.ci_sensorList]
+        L = ctf.SENSOR_LABEL
+        refs = [ctf.fmtChanName(ctf.nullstrip(sl[L * j : L * (j+1)]))
+                for j in range(ci[ctf.ci_ncoeff])]
+        lost = [c for c in refs if c not in keep]
+        if not lost:
+            n.coeffInfo.append(ci)
+        elif grad[name] != 0:
+            raise ValueError("channel %s is balanced, but its reference %s is not kept" %
+                (name, lost[0]))
+    return n
+
+class dsWriter(object):
+    """Create a new dataset dsname, using the .res4 information in r (as
+    returned by readRes4()) for channels chans (names or numbers, default
+    all). Trials are appended with putTrial() or putRawTrial(), and the
+    .res4 file, with the final number of trials, is written by close().
+
+        with dsWriter("new.ds", ds.r, idx) as w:
+            for tr in range(ds.getNumberOfTrials()):
+                w.putTrial(process(ds.getIdxArray(tr, idx)))
+    """
+
+    def __init__(self, dsname, r, chans = None):
+        dsname = os.path.expanduser(dsname)
+        if dsname[-1] == '/':
+            dsname = dsname[:-1]
+        b = os.path.basename(dsname)
+        if b[-3:] != '.ds':
+            raise ValueError("%s is not a dataset name" % dsname)
+        self.idx = chanIdx(r, chans)
+        subsetRes4(r, self.idx, 0)      # check the channels before writing
+        os.makedirs(dsname)
+        self.dsname = dsname
+        self.setname = b[:-3]
+        self.r = r
+        self.gain = r.chanGain[self.idx]
+        self.shape = (len(self.idx), r.numSamples)
+        self.ntrials = 0
+        self.part = 0
+        self.f = None
+        self._newPart()
+
+    def _newPart(self):
+        """Start the next part of the .meg4 file."""
+
+        if self.f is not None:
+            self.f.close()
+        ext = ".meg4" if self.part == 0 else ".%d_meg4" % self.part
+        self.f = open(os.path.join(self.dsname, self.setname + ext), 'wb')
+        self.f.write(MEG4HDR.encode())
+        self.size = len(MEG4HDR)
+        self.part += 1
+
+    def putRawTrial(self, a):
+        """Append a trial of raw samples, an int32 (channels, samples)
+        array as stored in the memmap (e.g., ds.dsData.m[tr][idx])."""
+
+        a = np.ascontiguousarray(a, dtype = 'int32')
+        if a.shape != self.shape:
+            raise ValueError("trial has shape %s, expected %s" % (a.shape, self.shape))
+        if self.size + a.nbytes > MAX_MEG4:
+            self._newPart()
+        self.f.write(a.tobytes())
+        self.size += a.nbytes
+        self.ntrials += 1
+
+    def putTrial(self, x):
+        """Append a trial of data, in the units returned by the getters."""
+
+        self.putRawTrial(encode(x, self.gain))
+
+    def close(self):
+        """Finish the .meg4 file and write the .res4 file."""
+
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        n = subsetRes4(self.r, self.idx, self.ntrials)
+        ctf.write_res4_structs(os.path.join(self.dsname, self.setname + '.res4'), n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def dsSubset(ds, dsname, chans = None, trials = None):
+    """Create the dataset dsname from channels chans and trials trials
+    (default all) of the open dataset ds. The samples are copied raw, one
+    trial at a time. The .hc file is copied, and the markers in the
+    selected trials are written with the new trial numbers."""
+
+    T = ds.getNumberOfTrials()
+    if trials is None:
+        trials = range(T)
+    trials = list(trials)
+    with dsWriter(dsname, ds.r, chans) as w:
+        for tr in trials:
+            w.putRawTrial(ds.dsData.m[tr][w.idx])
+
+    hc = ds.getDsFileNameExt('.hc')
+    if os.path.exists(hc):
+        shutil.copyfile(hc, os.path.join(w.dsname, w.setname + '.hc'))
+
+    # Keep the marks in the selected trials, renumbered.
+
+    if len(ds.marks) > 0:
+        new = np.full(T, -1)
+        new[np.asarray(trials, dtype = int)] = np.arange(len(trials))
+        m = markers(w.dsname)
+        for name in ds.marks.keys():
+            e = ds.marks.events(name)
+            tr = new[e['trial']]
+            keep = tr >= 0
+            m.setMark(name, tr[keep], e['time'][keep], **ds.marks.info[name])
+        m.write()
@@ -75,3 +75,51 @@ Returns a vector only rotated by m, useful for normals."""
     r = m[0:3, 0:3]
     return numpy.inner(r, v)
 
+# Batched versions. Each point argument may be a stack of points, shaped
+# (..., 3), and the transforms are stacks of 4x4 matrices, (..., 4, 4).
+# The leading axes broadcast, as usual for numpy.
+
+def _normalize_batch(x):
+    return x / numpy.sqrt((x * x).sum(axis = -1, keepdims = True))
+
+def fid_batch(nasn, lear, rear):
+    """m = fid_batch(nasn, lear, rear)
+Like fid(), but for stacks of fiducial points, returning a stack of 4x4
+transforms. Degenerate point sets give NaNs rather than an error."""
+
+    nasn = numpy.asarray(nasn, dtype = 'd')
+    lear = numpy.asarray(lear, dtype = 'd')
+    rear = numpy.asarray(rear, dtype = 'd')
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        o = (lear + rear) / 2.
+        x = _normalize_batch(nasn - o)
+        z = _normalize_batch(numpy.cross(rear - o, x))
+        y = _normalize_batch(numpy.cross(z, x))
+
+    # The basis is orthonormal, so the inverse of [x y z | o] is just
+    # the transpose of the rotation, and the rotated translation.
+
+    r = numpy.stack((x, y, z), axis = -2)
+    shape = r.shape[:-2]
+    m = numpy.zeros(shape + (4, 4), 'd')
+    m[..., 0:3, 0:3] = r
+    m[..., 0:3, 3] = -numpy.matmul(r, o[..., None])[..., 0]
+    m[..., 3, 3] = 1.
+    return m
+
+def fid_transform_batch(m, v):
+    """fid_transform_batch(m, v)
+Returns the vectors v (..., 3) rotated and translated by the 4x4
+transforms m (..., 4, 4)."""
+
+    r = m[..., 0:3, 0:3]
+    t = m[..., 0:3, 3]
+    return numpy.matmul(r, numpy.asarray(v)[..., None])[..., 0] + t
+
+def fid_rotate_batch(m, v):
+    """fid_rotate_batch(m, v)
+Returns the vectors v (..., 3) only rotated by m, useful for normals."""
+
+    r = m[..., 0:3, 0:3]
+    return numpy.matmul(r, numpy.asarray(v)[..., None])[..., 0]
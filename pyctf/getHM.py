@@ -1,6 +1,7 @@
+import sys, os, io
 import numpy
-import pyctf
-from pyctf import fid
+from .ctf_meg4 import meg4Parts
+from .util import atomicWrite
 
 # Continuous head localization channels.
 
@@ -9,33 +10,107 @@ chans = {fids[0]: ['HLC0011', 'HLC0012', 'HLC0013'],
          fids[1]: ['HLC0021', 'HLC0022', 'HLC0023'],
          fids[2]: ['HLC0031', 'HLC0032', 'HLC0033']}
 
+def hlcIdx(ds):
+    """Return the indices of the nine HLC channels, Na x y z, Le x y z,
+    Re x y z."""
+
+    d = ds.channel
+    return [d[ch] for f in fids for ch in chans[f]]
+
+def toHead(ds, x):
+    """Transform an (..., 3 fiducials, 3) array of dewar coordinates in
+    meters, as recorded in the HLC channels, to head coordinates in cm.
+    This is fid.fid_transform() done for every row at once."""
+
+    m = ds.dewar_to_head    # 4x4 transform
+    r = m[0:3, 0:3]         # 3x3 rotation
+    t = m[0:3, 3]           # translation
+    return numpy.inner(x * 100., r) + t     # m -> cm
+
 def getHM(ds, t, chan):
     if chan not in fids:
         raise KeyError("no such channel %s" % chan)
     i = fids.index(chan)
     o = ds.head[i]
-    c = chans[chan]
     d = ds.channel
 
-    # make an nx3; one channel per column
+    # Read all three channels at once, and make an nx3; one channel per column.
 
-    l = []
-    for ch in c:
-        x = ds.getDsRawData(t, d[ch])
-        x.shape = (x.shape[0], 1)
-        l.append(x)
-    d = numpy.hstack(l) * 100. # m -> cm
+    S = ds.getNumberOfSamples()
+    x = ds.getSpan([d[ch] for ch in chans[chan]], t * S, S)
 
     # Transform to relative head coordinates.
-    # fid.fid_transform() only does one vector, but
-    # we can do the whole array just as easily.
 
-    m = ds.dewar_to_head    # 4x4 transform
-    r = m[0:3, 0:3]         # 3x3 rotation
-    t = m[0:3, 3]           # translation
-    d = numpy.inner(d, r) + t - o # - o makes relative to .hc origin
+    return toHead(ds, x.T) - o  # - o makes relative to .hc origin
+
+def getHMTimeline(ds, decim = 1, dtype = None):
+    """Return the head coil positions over the whole recording as an
+    (N, 3, 3) array, [sample, fiducial (Na, Le, Re), xyz], in cm in the
+    head frame of the .hc file. Row k is absolute sample k * decim (see
+    ds.cont); N is ceil(T * S / decim). The nine HLC channels are read
+    together in one pass over the data, a few trials at a time."""
+
+    idx = hlcIdx(ds)
+    total = ds.getNumberOfTrials() * ds.getNumberOfSamples()
+    N = (total + decim - 1) // decim
+    x = numpy.empty((N, 9), dtype = dtype or numpy.float64)
+
+    # Chunks are a multiple of decim long, so every chunk starts on a kept sample.
+
+    k = 0
+    for start, a in ds.iterChunks(idx, decim * ds.getNumberOfSamples(), dtype = dtype):
+        a = a[:, ::decim].T
+        x[k : k + len(a)] = a
+        k += len(a)
+
+    return toHead(ds, x.reshape((N, 3, 3)))
+
+def hmName(ds):
+    """Return the name of the head motion summary sidecar file."""
+
+    return ds.getDsFileNameExt('.hm.npz')
+
+def getHMSummary(ds, cache = True):
+    """Return per-trial head motion summaries (maxd, meand), each a
+    (trials, 3 fiducials) array: the maximum and mean distance in cm of
+    each head coil from its position in the .hc file. If cache is true
+    the result is kept in the sidecar file hmName(ds), which is reused
+    while it is newer than the .meg4, .res4 and .hc files."""
+
+    name = hmName(ds)
+    src = meg4Parts(ds.getDsFileNameExt('.meg4'))
+    src.append(ds.getDsFileNameExt('.res4'))
+    src.append(ds.getDsFileNameExt('.hc'))
+    if cache:
+        try:
+            if os.path.getmtime(name) >= max(os.path.getmtime(x) for x in src):
+                with numpy.load(name) as z:
+                    return z['maxd'], z['meand']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    # One trial at a time, so the memory used doesn't grow with the recording.
+
+    T = ds.getNumberOfTrials()
+    S = ds.getNumberOfSamples()
+    o = numpy.asarray(ds.head)
+    maxd = numpy.empty((T, 3))
+    meand = numpy.empty((T, 3))
+    for start, a in ds.iterChunks(hlcIdx(ds), S):
+        tr = start // S
+        x = toHead(ds, a.T.reshape((S, 3, 3))) - o
+        d = numpy.sqrt((x * x).sum(axis = 2))
+        maxd[tr] = d.max(axis = 0)
+        meand[tr] = d.mean(axis = 0)
 
-    return d
+    if cache:
+        f = io.BytesIO()
+        numpy.savez(f, maxd = maxd, meand = meand)
+        try:
+            atomicWrite(name, f.getbuffer())
+        except OSError as e:
+            print("[pyctf] Note: can't write {}: {}".format(name, e), file = sys.stderr)
+    return maxd, meand
 
 #    d = ds.channel
 #    if chan in fids:
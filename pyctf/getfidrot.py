@@ -7,27 +7,23 @@
 
 from math import sqrt, acos, pi
 import numpy as np
-from .fid import fid, fid_transform
+from .fid import fid, fid_transform_batch, fid_batch
 
-__all__ = ['getfidrot']
+__all__ = ['getfidrot', 'getfidrot_batch']
 
-def getfidrot(p1, p2):
+def getfidrot(p1, p2, verbose = True):
     """Given two sets of 3D points, stored as ROWS of the arrays p1 and p2,
     compute R (3x3) and T (3x1) such that p2 ~ Rp1 + T. This version assumes
     there are 3 points in each set, representing fiducial locations. The
-    rotation angle and translation distance are reported."""
+    rotation angle and translation distance are reported if verbose is
+    true. Returns (R, T, theta, dist); R and T are in the FID frame of p1."""
 
     # Compute a FID basis for the first set of points, and map both
     # sets into that frame.
 
-    q1 = np.zeros_like(p1)
-    q2 = np.zeros_like(p2)
-
     m = fid(p1[0], p1[1], p1[2])    # nasn, lear, rear
-    for i in range(3):
-        q1[i, :] = fid_transform(m, p1[i])
-    for i in range(3):
-        q2[i, :] = fid_transform(m, p2[i])
+    q1 = fid_transform_batch(m, p1)
+    q2 = fid_transform_batch(m, p2)
 
     # Subtract the centroids --- here, the first set is already centered on
     # the origin, so we only need to translate the second set. Also, use
@@ -41,11 +37,10 @@ def getfidrot(p1, p2):
     c2 = (q2[1] + q2[2]) / 2    # midpoint between lear and rear
     q2 = q2 - c2
 
-    # Compute covariance matrix and SVD.
+    # Compute covariance matrix (the sum of the outer products of the
+    # point pairs) and SVD.
 
-    h = 0
-    for i in range(3):
-        h += np.outer(q1[i], q2[i])
+    h = q1.T.dot(q2)
 
     u, d, v = np.linalg.svd(h)
 
@@ -73,14 +68,71 @@ def getfidrot(p1, p2):
 
     # Compute the rotation angle and distance translated
 
-    costheta = .5 * sqrt(1. + np.trace(r))
+    costheta = min(.5 * sqrt(1. + np.trace(r)), 1.)
     theta = 2. * acos(costheta) * 180 / pi
     dist = sqrt((t * t).sum())
 
-    print("Total rotation = {:4.2f} degrees, translation = {:4.2f} cm".format(theta, dist))
+    if verbose:
+        print("Total rotation = {:4.2f} degrees, translation = {:4.2f} cm".format(theta, dist))
 
     #p2new = r.dot(p1.T).T + t  # this transforms p1 towards p2
 
+    return r, t, theta, dist
+
+def getfidrot_batch(p1, p2):
+    """Like getfidrot(), for stacks of fiducial sets. p1 and p2 are
+    (..., 3, 3) arrays of points, stored as rows, and broadcast against
+    each other, so p1 may be one reference set (e.g. ds.head) and p2 a
+    whole timeline (see getHM.getHMTimeline()). Returns (R, T, theta,
+    dist), shaped (..., 3, 3), (..., 3), (...) and (...). Where no
+    rotation can be computed the results are NaN."""
+
+    p1 = np.asarray(p1, dtype = 'd')
+    p2 = np.asarray(p2, dtype = 'd')
+
+    # Map both sets into the FID frame of the first.
+
+    m = fid_batch(p1[..., 0, :], p1[..., 1, :], p1[..., 2, :])[..., None, :, :]
+    q1 = fid_transform_batch(m, p1)
+    q2 = fid_transform_batch(m, p2)
+
+    c2 = (q2[..., 1, :] + q2[..., 2, :]) / 2
+    q2 = q2 - c2[..., None, :]
+
+    # Stacked covariance matrices and SVDs. NaN inputs make the SVD
+    # fail, so solve only the finite ones.
+
+    h = np.matmul(np.swapaxes(q1, -1, -2), q2)
+    h, c2 = np.broadcast_arrays(h, c2[..., None, :])
+    c2 = c2[..., 0, :]
+    ok = np.isfinite(h).all(axis = (-2, -1))
+    u = np.full(h.shape, np.nan)
+    d = np.full(h.shape[:-1], np.nan)
+    v = np.full(h.shape, np.nan)
+    if ok.any():
+        u[ok], d[ok], v[ok] = np.linalg.svd(h[ok])
+
+    # Orthogonal rotations, flipping the last vector where the
+    # determinant is -1 and the smallest singular value is zero.
+
+    ut = np.swapaxes(u, -1, -2)
+    r = np.matmul(np.swapaxes(v, -1, -2), ut)
+    with np.errstate(invalid = 'ignore'):
+        det = np.linalg.det(r)
+        flip = (det < 0) & (np.abs(d[..., 2]) <= .01)
+        v[..., 2, :] = np.where(flip[..., None], -v[..., 2, :], v[..., 2, :])
+        r = np.matmul(np.swapaxes(v, -1, -2), ut)
+        bad = ~(np.abs(det) >= .01) | ((det < 0) & ~flip)
+
+        r[bad] = np.nan
+        t = np.where(bad[..., None], np.nan, c2)
+
+        costheta = np.minimum(.5 * np.sqrt(1. + np.trace(r, axis1 = -2, axis2 = -1)), 1.)
+        theta = 2. * np.arccos(costheta) * 180 / pi
+        dist = np.sqrt((t * t).sum(axis = -1))
+
+    return r, t, theta, dist
+
 if __name__ == '__main__':
     p1 = np.array([
         [6.21, 7.25, -24.3],
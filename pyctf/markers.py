@@ -1,63 +1,149 @@
-import os
+import os, re
+import numpy as np
+from .util import atomicWrite, parseRecords, formatRecords
+
+# The samples of each marker are stored in a structured array.
+
+MARKDTYPE = np.dtype([('trial', int), ('time', float)])
 
 class markers:
     """Access to the markers of a CTF dataset. Each marker becomes a key
-    that returns a list of (trial, time) pairs."""
+    that returns a list of (trial, time) pairs. The samples are stored as
+    numpy arrays, see events(), trials(), and times(); the lists are only
+    made when asked for. The other fields of each marker (COMMENT, COLOR,
+    etc.) are kept in self.info[name]."""
 
     def __getitem__(self, key):
-        return self.marks[key]
+        l = self.marks.get(key)
+        if l is None:
+            e = self.ev[key]
+            l = list(zip(e['trial'].tolist(), e['time'].tolist()))
+            self.marks[key] = l
+        return l
 
     #def __setitem__(self, key, value):
     #    self.marks[key] = value
 
     def get(self, key):
-        return self.marks.get(key)
+        if key not in self.ev:
+            return None
+        return self[key]
 
     def keys(self):
-        return self.marks.keys()
+        return self.ev.keys()
+
+    def __contains__(self, key):
+        return key in self.ev
+
+    def __len__(self):
+        return len(self.ev)
+
+    def events(self, key):
+        """Return the samples of marker key as an array with fields
+        'trial' and 'time'."""
+        return self.ev[key]
+
+    def trials(self, key):
+        """Return an array of the trial numbers of marker key."""
+        return self.ev[key]['trial']
+
+    def times(self, key):
+        """Return an array of the times (in seconds) of marker key."""
+        return self.ev[key]['time']
 
     def __init__(self, dsname):
-        self.marks = {}
+        self.marks = {}         # list views, made by __getitem__()
+        self.ev = {}            # structured arrays of samples
+        self.info = {}          # the other fields of each marker
+        self.dsname = dsname
 
         markerfilename = os.path.join(dsname, 'MarkerFile.mrk')
         try:
             f = open(markerfilename)
         except:
             return
-
-        # Parse the file. Look at each line.
-
-        START = 1
-        MARK = 2
-        NUM = 3
-        LIST = 4
-        state = START
-
-        for l in f:
-            s = l.split(':')
-            if state == START:
-                if s[0] == 'CLASSGROUPID':
-                    state = MARK
-            elif state == MARK:
-                if s[0] == 'NAME':
-                    name = next(f).split()[0]
-                    state = NUM
-            elif state == NUM:
-                if s[0] == 'NUMBER OF SAMPLES':
-                    num = int(next(f).split()[0])
-                    state = LIST
-            elif state == LIST:
-                    next(f)
-                    self._get_samples(f, name, num)
-                    state = START
+        lines = f.read().split('\n')
         f.close()
 
-    def _get_samples(self, f, name, num):
-        "Add all the samples for a marker to the marks dict."
-        for x in range(num):
-            l = next(f).split()
-            trial = int(l[0])
-            t = float(l[1])
-            if not self.marks.get(name):
-                self.marks[name] = []
-            self.marks[name].append((trial, t))
+        # The samples of each marker are converted in one go.
+
+        for info, rows in parseRecords(lines, 'SAMPLES'):
+            name = (info.get('NAME', '').split() or [''])[0]
+            self._add_samples(name, rows, info)
+
+    def _add_samples(self, name, lines, info):
+        "Convert the sample lines of a marker to an array."
+        if lines:
+            e = np.loadtxt(lines, dtype = MARKDTYPE, ndmin = 1)
+        else:
+            e = np.zeros(0, dtype = MARKDTYPE)
+        self.ev[name] = e
+        self.info[name] = info
+
+    # Changing and writing the markers.
+
+    def setMark(self, name, trials, times = None, **info):
+        """Add the marker name, or replace it if it exists. The samples are
+        either a list of (trial, time) pairs, or separate sequences of
+        trials and times. Keyword arguments set the other fields of the
+        marker, e.g. COLOR = 'red', COMMENT = '...'. The file is not
+        changed until write() is called."""
+
+        if times is None:
+            a = np.asarray(trials, dtype = float).reshape((-1, 2))
+            trials, times = a[:, 0], a[:, 1]
+        trials = np.asarray(trials).ravel()
+        times = np.asarray(times, dtype = float).ravel()
+        if trials.shape != times.shape:
+            raise ValueError("trials and times must have the same length")
+        e = np.empty(len(trials), dtype = MARKDTYPE)
+        e['trial'] = trials
+        e['time'] = times
+
+        old = self.info.get(name, {})
+        d = {'CLASSGROUPID': '3', 'NAME': name, 'COMMENT': '',
+             'COLOR': 'blue', 'EDITABLE': 'Yes'}
+        d.update(old)
+        d.update(info)
+        self.ev[name] = e
+        self.info[name] = d
+        self.marks.pop(name, None)
+
+    def delMark(self, name):
+        """Delete the marker name. The file is not changed until write()."""
+
+        del self.ev[name]
+        del self.info[name]
+        self.marks.pop(name, None)
+
+    def write(self, filename = None):
+        """Write all the markers to MarkerFile.mrk (or filename). The new
+        file is written with util.atomicWrite(). Markers are numbered in
+        order."""
+
+        if filename is None:
+            filename = os.path.join(self.dsname, 'MarkerFile.mrk')
+        records = []
+        for name, e in self.ev.items():
+            rows = list(map("{:20d}{:+48.12g}\n".format,
+                            e['trial'].tolist(), e['time'].tolist()))
+            records.append((name, self.info[name], rows))
+        atomicWrite(filename, formatRecords(self.dsname, 'MARKERS', 'SAMPLES',
+            "TRIAL NUMBER\t\tTIME FROM SYNC POINT (in seconds)", records))
+
+_name = re.compile(r'^NAME:[ \t]*\r?\n(.*)$', re.M)
+_count = re.compile(r'^NUMBER OF SAMPLES:[ \t]*\r?\n\s*(\d+)', re.M)
+
+def markerCounts(dsname):
+    """Return a dict mapping the name of each marker of a dataset to its
+    number of samples, without parsing the samples themselves."""
+
+    markerfilename = os.path.join(dsname, 'MarkerFile.mrk')
+    try:
+        with open(markerfilename) as f:
+            s = f.read()
+    except OSError:
+        return {}
+    names = [(x.split() or [''])[0] for x in _name.findall(s)]
+    counts = [int(x) for x in _count.findall(s)]
+    return dict(zip(names, counts))
@@ -0,0 +1,87 @@
+# Run a function over the trials or segments of a dataset with a pool of
+# worker processes. Each worker opens the dataset itself, so the data are
+# read through the worker's own memmap and never pickled.
+
+import os
+from multiprocessing import Pool
+from .dsopen import dsopen
+
+__all__ = ['dsmap']
+
+# Per-worker state, set up by _init().
+
+_ds = None
+_func = None
+
+def _init(dsname, func, kw):
+    global _ds, _func
+    _ds = dsopen(dsname, **kw)
+    _func = func
+
+def _apply(ds, func, item):
+    # A (tr, s) pair, as a tuple or a list, is spread into the call.
+    if isinstance(item, (tuple, list)):
+        return func(ds, *item)
+    return func(ds, item)
+
+def _call(item):
+    return _apply(_ds, _func, item)
+
+def dsmap(ds, func, items = None, nproc = None, reducer = None,
+          initial = None, chunksize = 1, **kw):
+    """Call func(ds, tr) for each trial tr of the dataset ds (an open
+    dsopen object or a dataset name), using nproc worker processes
+    (default, one per CPU). If items is given, it is a list of trials or
+    a seglist from get_segment_list(); for a (tr, s) pair the call is
+    func(ds, tr, s). func must be picklable, i.e., defined at the top
+    level of a module. Extra keyword arguments are passed to dsopen()
+    in each worker. With nproc = 1 the calls are made in this process,
+    on ds itself if it is open; a dataset opened from its name is
+    closed again.
+
+    The results are returned as a list, in the order of items. If
+    reducer is given, they are instead merged in order with
+    acc = reducer(acc, result), starting from initial (default, the
+    first result), and the final acc is returned."""
+
+    if isinstance(ds, str):
+        dsname = ds
+        ds = None
+        if items is None:
+            # Only the .res4 file is needed to count the trials.
+            d = dsopen(dsname, lazy = True)
+            items = range(d.getNumberOfTrials())
+            d.close()
+    else:
+        dsname = ds.dsname
+        if items is None:
+            items = range(ds.getNumberOfTrials())
+    if hasattr(items, 'ndim') and items.ndim == 2:
+        items = [tuple(x) for x in items.tolist()]
+
+    if nproc is None:
+        nproc = os.cpu_count()
+
+    def merge(results):
+        if reducer is None:
+            return list(results)
+        acc = initial
+        first = initial is None
+        for r in results:
+            if first:
+                acc = r
+                first = False
+            else:
+                acc = reducer(acc, r)
+        return acc
+
+    if nproc == 1:
+        d = ds if ds is not None else dsopen(dsname, **kw)
+        try:
+            return merge(_apply(d, func, x) for x in items)
+        finally:
+            if ds is None:
+                d.close()
+
+    with Pool(nproc, _init, (dsname, func, kw)) as pool:
+        return merge(pool.imap(_call, items, chunksize))
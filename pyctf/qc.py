@@ -0,0 +1,167 @@
+# Channel and trial quality control. Every trial is read once, and a few
+# statistics are kept for each (trial, channel); the bad channels and
+# trials are then found from those with thresholds.
+
+import sys, os, json
+import numpy as np
+from .dsopen import dsopen
+from . import ctf_res4 as ctf
+from . import util
+
+__all__ = ['qcScan', 'qcFlag', 'qcReport', 'runQC']
+
+# Default thresholds, see qcFlag().
+
+THRESHOLDS = {
+    'jump': 10.,        # a jump is a step this many times the median step
+    'flat': .5,         # channels with more than this fraction of repeated samples are flat
+    'noisy': 10.,       # channels with more than this times the median variance are noisy
+    'trialVar': 10.,    # trials with more than this times a channel's median variance are bad
+    'maxJumps': 0,      # trials with more jumps than this are bad
+    'maxPtp': None,     # trials with a larger peak-to-peak (in T, say) are bad
+}
+
+def qcScan(ds, idx = None, jump = THRESHOLDS['jump']):
+    """Read every trial of ds once and return a dict of (trials, channels)
+    arrays of statistics for channels [idx] (default, the primaries):
+        var     variance
+        ptp     peak-to-peak
+        flat    fraction of samples equal to the one before
+        jumps   number of steps larger than jump times the median step
+    """
+
+    if idx is None:
+        idx = ds.r.chanTable.ofType(ctf.TYPE_MEG)
+    idx = np.asarray(idx, dtype = int).ravel()
+    T = ds.getNumberOfTrials()
+    C = len(idx)
+    stats = {k: np.empty((T, C)) for k in ('var', 'ptp', 'flat', 'jumps')}
+
+    x = np.empty((C, ds.getNumberOfSamples()))
+    for tr in range(T):
+        ds.getIdxArray(tr, idx, out = x)
+        d = np.abs(np.diff(x, axis = 1))
+        med = np.median(d, axis = 1, keepdims = True)
+        stats['var'][tr] = (x * x).mean(axis = 1)     # the mean is removed
+        stats['ptp'][tr] = np.ptp(x, axis = 1)
+        stats['flat'][tr] = (d == 0).mean(axis = 1)
+        stats['jumps'][tr] = (d > jump * med).sum(axis = 1) * (med[:, 0] > 0)
+    stats['idx'] = idx
+    return stats
+
+def qcFlag(stats, **thresholds):
+    """Find the bad channels and trials in the statistics from qcScan(),
+    using the THRESHOLDS, which may be overridden with keyword arguments.
+    Channels are flat if their median flat fraction (over trials) is over
+    flat, or their median peak-to-peak is zero, and noisy if their median
+    variance is over noisy times the median over the channels. Trials are
+    bad if, on a good channel, the variance is over trialVar times the
+    channel's median, the peak-to-peak is over maxPtp, or the number of
+    jumps (summed over the good channels) is over maxJumps.
+    Returns (flat, noisy, badtrials), the first two as indices into
+    stats['idx']."""
+
+    th = dict(THRESHOLDS)
+    for k, v in thresholds.items():
+        if k not in th:
+            raise KeyError("unknown threshold %s" % k)
+        th[k] = v
+
+    var = np.median(stats['var'], axis = 0)
+    flat = (np.median(stats['flat'], axis = 0) > th['flat']) | \
+           (np.median(stats['ptp'], axis = 0) == 0)
+    good = ~flat
+    noisy = good & (var > th['noisy'] * np.median(var[good] if good.any() else var))
+    good &= ~noisy
+
+    v = stats['var'][:, good]
+    bad = (v > th['trialVar'] * var[good]).any(axis = 1)
+    if th['maxPtp'] is not None:
+        bad |= (stats['ptp'][:, good] > th['maxPtp']).any(axis = 1)
+    bad |= stats['jumps'][:, good].sum(axis = 1) > th['maxJumps']
+
+    return np.flatnonzero(flat), np.flatnonzero(noisy), np.flatnonzero(bad)
+
+def qcReport(ds, stats, flags, thresholds = {}):
+    """Return a JSON-ready dict describing the QC results."""
+
+    flat, noisy, bad = flags
+    names = ds.r.chanTable.name[stats['idx']]
+    th = dict(THRESHOLDS)
+    th.update(thresholds)
+    return {
+        'dataset': ds.dsname,
+        'thresholds': th,
+        'channels': names.tolist(),
+        'flatChannels': names[flat].tolist(),
+        'noisyChannels': names[noisy].tolist(),
+        'badTrials': bad.tolist(),
+        'channelVar': np.median(stats['var'], axis = 0).tolist(),
+        'channelPtp': np.median(stats['ptp'], axis = 0).tolist(),
+        'trialJumps': stats['jumps'].sum(axis = 1).astype(int).tolist(),
+    }
+
+def runQC(ds, idx = None, classfile = True, report = None, **thresholds):
+    """Run qcScan() and qcFlag() on ds (an open dataset or a name). If
+    classfile is true, the bad trials are added to the BAD class of the
+    dataset's ClassFile.cls; the other classes are kept. If report is
+    given, the qcReport() is written there as JSON. Returns the report.
+    A dataset opened here from its name is closed again."""
+
+    opened = isinstance(ds, str)
+    if opened:
+        ds = dsopen(ds, lazy = True)
+    try:
+        stats = qcScan(ds, idx, thresholds.get('jump', THRESHOLDS['jump']))
+        flags = qcFlag(stats, **thresholds)
+        rep = qcReport(ds, stats, flags, thresholds)
+        if classfile:
+            c = ds.classes
+            c.addTrials('BAD', flags[2])
+            c.write()
+        if report is not None:
+            util.atomicWrite(report, json.dumps(rep, indent = 1))
+    finally:
+        if opened:
+            ds.close()
+    return rep
+
+def main():
+    util.usage("""[-n] [-o report] [-t name=value ...] dataset ...
+Check the primary channels of each dataset for flat or noisy channels
+and bad trials. The bad trials are added to the BAD class in ClassFile.cls
+(-n: don't write it). The report is written to report (with several
+datasets, report is a directory and <set>.json is written there), or
+printed. -t sets a threshold, see pyctf.qc.THRESHOLDS.""")
+
+    optlist, args = util.parseargs("no:t:")
+    classfile = True
+    report = None
+    thresholds = {}
+    for opt, arg in optlist:
+        if opt == '-n':
+            classfile = False
+        elif opt == '-o':
+            report = arg
+        elif opt == '-t':
+            k, _, v = arg.partition('=')
+            if k not in THRESHOLDS:
+                util.printerror("unknown threshold %s" % k)
+                sys.exit(1)
+            thresholds[k] = None if v == 'None' else float(v)
+    if not args:
+        util.printusage()
+        sys.exit(1)
+
+    for dsname in args:
+        out = report
+        if out is not None and len(args) > 1:
+            setname = os.path.basename(os.path.normpath(dsname))[:-3]
+            out = os.path.join(report, setname + '.json')
+        rep = runQC(dsname, None, classfile, out, **thresholds)
+        if out is None:
+            json.dump(rep, sys.stdout, indent = 1)
+            print()
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,11 @@
 from warnings import warn
-try:
-    from functools import cmp_to_key
-except:
-    def cmp_to_key(mycmp):      # py2.6 doesn't have this
-        class K(object):
-            def __init__(self, obj, *args):
-                self.obj = obj
-            def __lt__(self, other):
-                return mycmp(self.obj, other.obj) < 0
-            def __eq__(self, other):
-                return mycmp(self.obj, other.obj) == 0
-        return K
-
-def get_segment_list(ds, mlist, t0, t1):
-    """Create a list of segments of a dataset. A segment is specified
-    using times in seconds relative to marks of the dataset, and
-    generates a list of (tr, s) pairs, where each segment starts at
-    sample s of trial tr, and ends at sample s + seglen - 1.
-    This function returns (seglist, seglen)."""
+import numpy as np
+
+def get_segment_arrays(ds, mlist, t0, t1, cross = None):
+    """Like get_segment_list(), but return the segments as parallel
+    arrays (trials, starts, seglen): segment k starts at sample starts[k]
+    of trial trials[k], and is seglen samples long. The segments are
+    sorted by trial and start."""
 
     # Check the marks in mlist. Convert a string to a list of length 1.
 
@@ -26,7 +14,7 @@ def get_segment_list(ds, mlist, t0, t1):
 
     marks = ds.marks
     for m in mlist:
-        if not marks.get(m):
+        if m not in marks or len(marks.trials(m)) == 0:
             raise ValueError("unknown marker '%s'" % m)
 
     # Get (tr, s) for all specified marks.
@@ -35,51 +23,91 @@ def get_segment_list(ds, mlist, t0, t1):
     if not mlist:
         # If there are no marks, each trial becomes a segment.
         ntrials = ds.getNumberOfTrials()
-        seglist = list(zip(range(ntrials), [0] * ntrials))
-        seglen = nsamples
-        return seglist, seglen
+        return np.arange(ntrials), np.zeros(ntrials, dtype = int), nsamples
 
     srate = ds.getSampleRate()
     seglen = int((t1 - t0) * srate + .5)
-    seglist = []
-    for m in mlist:
-        seglist.extend(marks[m])
-
-    # Bounds check, make sure we are always inside trial boundaries.
-
-    T0 = ds.getTimePt(0)
-    T1 = ds.getTimePt(nsamples - 1)
-    def bck(t):
-        if T0 <= t[1] + t0 and t[1] + t1 <= T1:
-            return True
-        warn("mark at trial %d, time %g, out of bounds" % t)
-        return False
-    seglist = filter(bck, seglist)
-
-    # Convert t0 + marker time (t[1]) to samples.
-
-    def cvt2s(t):
-        return (t[0], ds.getSampleNo(t[1] + t0))
-    seglist = list(map(cvt2s, seglist))
-
-    # Sort by trial (a) and time (b).
-
-    def cmp(a, b):
-        if a[0] < b[0]:
-            return -1
-        if a[0] == b[0]:
-            if a[1] < b[1]:
-                return -1
-            return 1
-        return 1
-    seglist.sort(key = cmp_to_key(cmp))
+    trials = np.concatenate([marks.trials(m) for m in mlist])
+    times = np.concatenate([marks.times(m) for m in mlist])
+
+    # Convert t0 + marker time to samples (see ds.getSampleNo()).
+
+    starts = np.floor((times + t0 + ds.getPreTrig()) * srate + .5).astype(int)
+
+    if cross is None:
+        cross = ds.isContinuous()
+
+    # Bounds check, make sure we are always inside trial boundaries, or,
+    # with cross, inside the recording. Crossing segments are given as
+    # (tr, s) with s inside trial tr.
+
+    if cross:
+        absolute = trials * nsamples + starts
+        total = ds.getNumberOfTrials() * nsamples
+        ok = (0 <= absolute) & (absolute + seglen <= total)
+    else:
+        T0 = ds.getTimePt(0)
+        T1 = ds.getTimePt(nsamples - 1)
+        ok = (T0 <= times + t0) & (times + t1 <= T1)
+    nbad = len(ok) - np.count_nonzero(ok)
+    if nbad:
+        i = np.flatnonzero(~ok)[0]
+        warn("%d of %d marks out of bounds, the first at trial %d, time %g" %
+             (nbad, len(ok), trials[i], times[i]))
+    trials = trials[ok]
+    starts = starts[ok]
+    if cross:
+        trials, starts = np.divmod(absolute[ok], nsamples)
+
+    # Sort by trial and time.
+
+    order = np.lexsort((starts, trials))
+    return trials[order], starts[order], seglen
+
+def get_segment_list(ds, mlist, t0, t1, cross = None):
+    """Create a list of segments of a dataset. A segment is specified
+    using times in seconds relative to marks of the dataset, and
+    generates a list of (tr, s) pairs, where each segment starts at
+    sample s of trial tr, and ends at sample s + seglen - 1.
+    If cross is true, the trials are treated as one continuous
+    recording, and a segment may start in one trial and end in the
+    next (s + seglen > the number of samples per trial). Such segments
+    are read correctly by ds.getSegmentArray() and ds.getEpochs().
+    Otherwise segments that fall outside their trial are dropped, with
+    a warning. By default cross is true for continuous recordings (see
+    ds.isContinuous()), and false for epoched or averaged data.
+    This function returns (seglist, seglen)."""
 
+    trials, starts, seglen = get_segment_arrays(ds, mlist, t0, t1, cross)
+    seglist = list(zip(trials.tolist(), starts.tolist()))
     return seglist, seglen
 
+def _trialArray(trlist):
+    # trlist may be any iterable of trial numbers, such as a set.
+    return np.fromiter(trlist, dtype = int)
+
 # Filter out unwanted trials. Specify the ones you want.
 
 def onlyTrials(seglist, trlist):
-    def intr(s, tr = trlist):
-        return s[0] in tr
-    seglist = list(filter(intr, seglist))
-    return seglist
+    if len(seglist) == 0:
+        return []
+    a = np.asarray(seglist, dtype = int).reshape((-1, 2))
+    keep = np.isin(a[:, 0], _trialArray(trlist))
+    return [tuple(x) for x in a[keep].tolist()]
+
+# Or the ones you don't want, e.g. the BAD class of ClassFile.cls.
+
+def excludeTrials(seglist, trlist):
+    if len(seglist) == 0:
+        return []
+    a = np.asarray(seglist, dtype = int).reshape((-1, 2))
+    keep = np.isin(a[:, 0], _trialArray(trlist), invert = True)
+    return [tuple(x) for x in a[keep].tolist()]
+
+def selectTrials(trials, starts, trlist, exclude = False):
+    """Like onlyTrials() (or excludeTrials(), if exclude is true) for the
+    arrays returned by get_segment_arrays(). Returns (trials, starts)."""
+
+    trials = np.asarray(trials, dtype = int)
+    keep = np.isin(trials, _trialArray(trlist), invert = exclude)
+    return trials[keep], np.asarray(starts, dtype = int)[keep]
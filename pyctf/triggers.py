@@ -0,0 +1,131 @@
+# Find trigger events in the TRIGGER, UPPT (and UADC) channels of a dataset.
+# The channels are read together, in large chunks that cross trial
+# boundaries, and the edges are found with array operations.
+
+import numpy as np
+from . import ctf_res4 as ctf
+from .markers import MARKDTYPE
+
+__all__ = ['triggerChannels', 'findTriggers', 'writeTriggers']
+
+# Channel types holding integer codes.
+
+CODE_TYPES = (ctf.TYPE_TRIGGER, ctf.TYPE_UPPT)
+
+CHUNK = 1 << 20         # default samples per chunk
+
+def triggerChannels(ds, analog = False):
+    """Return the channel numbers of the TRIGGER and UPPT channels, and
+    the UADC channels too if analog is true."""
+
+    t = ds.r.chanTable
+    types = CODE_TYPES + ((ctf.TYPE_UADC,) if analog else ())
+    return np.sort(np.concatenate([t.ofType(c) for c in types]))
+
+def _rawSpan(d, idx, start, n):
+    """Return n raw samples of channels [idx] of the dsData d, starting at
+    absolute sample start (see dsData.getSpan()), as int64."""
+
+    out = np.empty((len(idx), n), dtype = np.int64)
+    k = 0
+    while k < n:
+        tr, s = divmod(start + k, d.S)
+        m = min(d.S - s, n - k)
+        out[:, k : k + m] = d.m[tr, idx, s : s + m].view('>i4')
+        k += m
+    return out
+
+def findTriggers(ds, chans = None, mask = None, threshold = None,
+                 cross = False, size = 0):
+    """Find the onsets of the codes in the trigger channels of ds.
+
+    chans is a list of channel names or numbers; by default all the
+    TRIGGER and UPPT channels are used, plus the UADC channels if a
+    threshold is given. The code channels are read as raw integers from
+    the .meg4 file (never from a float32 sidecar), and anded with mask if
+    given. An analog (UADC) channel has code 1 where it is above threshold
+    and 0 elsewhere; the mask does not apply to it.
+
+    An event is a sample where the code is nonzero and differs from the
+    previous sample. Unless cross is true the trials are independent, so
+    a code present at the first sample of a trial is an event. With cross
+    true (for continuous recordings) the trials are back to back.
+
+    The data are read size samples at a time (default about a million).
+    Returns a dict mapping names of the form '<chan>_<code>' to arrays of
+    events, with fields 'trial' and 'time' like markers.events()."""
+
+    r = ds.r
+    if chans is None:
+        idx = triggerChannels(ds, threshold is not None)
+    else:
+        idx = np.array([c if isinstance(c, (int, np.integer)) else ds.channel[c]
+                        for c in chans], dtype = int)
+    if len(idx) == 0:
+        return {}
+    analog = np.isin(r.chanTable.type[idx], CODE_TYPES, invert = True)
+    if analog.any() and threshold is None:
+        raise ValueError("a threshold is needed for analog channels")
+    code = ~analog
+
+    S = r.numSamples
+    if size == 0:
+        size = max(S, CHUNK)
+    total = r.numTrials * S
+    last = np.zeros(len(idx), dtype = np.int64)     # code before each chunk
+    onsets = [[] for i in idx]                      # absolute samples
+    codes = [[] for i in idx]
+
+    for start in range(0, total, size):
+        n = min(size, total - start)
+        c = np.empty((len(idx), n), dtype = np.int64)
+        c[code] = _rawSpan(ds.dsData, idx[code], start, n)
+        if mask is not None:
+            c[code] &= mask
+        if analog.any():
+            c[analog] = ds.getSpan(idx[analog], start, n) > threshold
+
+        # Compare each sample with the one before it.
+
+        prev = np.empty_like(c)
+        prev[:, 0] = last
+        prev[:, 1:] = c[:, :-1]
+        if not cross:
+            first = (np.arange(start, start + c.shape[1]) % S) == 0
+            prev[:, first] = 0
+        last = c[:, -1]
+
+        ch, s = np.nonzero((c != 0) & (c != prev))
+        for k in np.unique(ch):
+            on = s[ch == k]
+            onsets[k].append(on + start)
+            codes[k].append(c[k, on])
+
+    # Split each channel's events by code, and convert to (trial, time).
+
+    events = {}
+    pretrig = ds.getPreTrigSamples()
+    srate = ds.getSampleRate()
+    for k, i in enumerate(idx):
+        if not onsets[k]:
+            continue
+        on = np.concatenate(onsets[k])
+        code = np.concatenate(codes[k])
+        tr, s = np.divmod(on, S)
+        for v in np.unique(code):
+            sel = code == v
+            e = np.empty(np.count_nonzero(sel), dtype = MARKDTYPE)
+            e['trial'] = tr[sel]
+            e['time'] = (s[sel] - pretrig) / srate
+            events["%s_%d" % (r.chanFname[i], v)] = e
+    return events
+
+def writeTriggers(ds, events, filename = None, **info):
+    """Add the events returned by findTriggers() to the markers of ds,
+    replacing markers with the same names, and write MarkerFile.mrk (or
+    filename). Keyword arguments set the other fields of each marker, as
+    for markers.setMark()."""
+
+    for name, e in events.items():
+        ds.marks.setMark(name, e['trial'], e['time'], **info)
+    ds.marks.write(filename)
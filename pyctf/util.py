@@ -34,6 +34,89 @@ def parseargs(*args):
         sys.exit(1)
     return optlist, args
 
+def atomicWrite(filename, data):
+    """Write data to filename. data is a str, bytes, or an iterable of
+    bytes-like chunks (so large files can be written piece by piece).
+    The file is written under a temporary name in the same directory
+    and then renamed into place, so readers never see a partial file,
+    and an interrupted write leaves nothing behind."""
+
+    d, b = os.path.split(os.path.abspath(filename))
+    tmp = os.path.join(d, ".%s.%s.tmp" % (b, os.urandom(4).hex()))
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = [data]
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for x in data:
+                f.write(x)
+        os.replace(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# MarkerFile.mrk and ClassFile.cls share a layout: a header, then one
+# record per marker (or class) of "FIELD:" lines, each followed by its
+# value on the next line, ending with a count and a list of items
+# (samples or trials).
+
+def parseRecords(lines, item):
+    """Parse the records of a MarkerFile.mrk (item 'SAMPLES') or
+    ClassFile.cls (item 'TRIALS'), given as a list of lines. Returns a
+    list of (info, rows) pairs, where info is a dict of the fields of a
+    record and rows is its list of item lines (after the column titles)."""
+
+    records = []
+    info = None
+    i = 0
+    n = len(lines)
+    while i < n:
+        key = lines[i].strip()
+        i += 1
+        if not key.endswith(':') or i >= n:
+            continue
+        key = key[:-1]
+        if key == 'CLASSGROUPID':
+            info = {key: lines[i].strip()}
+            i += 1
+        elif info is None:
+            i += 1          # PATH OF DATASET, NUMBER OF ...
+        elif key == 'LIST OF ' + item:
+            num = int(info.pop('NUMBER OF ' + item, 0))
+            i += 1          # column titles
+            records.append((info, lines[i : i + num]))
+            i += num
+            info = None
+        else:
+            info[key] = lines[i].strip()
+            i += 1
+    return records
+
+def formatRecords(dsname, kind, item, title, records):
+    """Return the text of a MarkerFile.mrk (kind 'MARKERS', item
+    'SAMPLES') or ClassFile.cls ('CLASSES', 'TRIALS'). records is a list
+    of (name, info, rows), where rows are the formatted item lines, and
+    title is the line of column titles. Records are numbered in order."""
+
+    l = ["PATH OF DATASET:\n{}\n\n\n".format(dsname),
+         "NUMBER OF {}:\n{}\n\n\n".format(kind, len(records))]
+    for classid, (name, info, rows) in enumerate(records, 1):
+        l.append("CLASSGROUPID:\n{}\n".format(info.get('CLASSGROUPID', '3')))
+        l.append("NAME:\n{}\n".format(name))
+        for key in info:
+            if key not in ('CLASSGROUPID', 'NAME', 'CLASSID'):
+                l.append("{}:\n{}\n".format(key, info[key]))
+        l.append("CLASSID:\n{}\n".format(classid))
+        l.append("NUMBER OF {}:\n{}\n".format(item, len(rows)))
+        l.append("LIST OF {}:\n".format(item))
+        l.append(title + "\n")
+        l.extend(rows)
+        l.append("\n\n")
+    return ''.join(l)
+
 def run(cmd, raw = False):
     try:
         p = subprocess.Popen(cmd, shell=True, close_fds=True,
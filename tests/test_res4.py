@@ -0,0 +1,59 @@
+import numpy as np
+from pyctf import ctf_res4 as ctf
+
+def makeRes4(M = 5, nref = 2, T = 3, S = 100):
+    """Return a res4data container for a small synthetic dataset, with
+    nref references and M - nref primaries, ready for write_res4_structs()."""
+
+    rng = np.random.default_rng(0)
+    names = [b'BR%d-1234' % (i + 1) for i in range(nref)]
+    names += [b'MLC%d-4408' % (i + 11) for i in range(M - nref)]
+    runDesc = b'synthetic'
+
+    r = ctf.res4data()
+    r.genRes = (b'app', b'origin', b'desc', 0, b'10:00', b'01/01/2020', S, M,
+        600., S / 600. * T, T, 20, T, 0, T, b'', 0, 0, 0, 0, 0, b'run',
+        b'title', b'inst', b'collect', b'subj', b'op', b'sens', len(runDesc) + 1)
+    r.runDesc = runDesc
+    r.filterInfo = [((100., 1, 2, 1), [1.5]), ((.1, 2, 1, 2), [1., 2.])]
+    r.chanName = names
+    r.sensRes = []
+    for i in range(M):
+        t = ctf.TYPE_REF_MAG if i < nref else ctf.TYPE_MEG
+        sr = (t, 1, 0, 1e8 * (i + 1), 1e4, 1., 0., 2, 0, 0)
+        coils = [tuple(rng.normal(size = 6)) + (j + 1, .1) for j in range(ctf.MAX_COILS)]
+        r.sensRes.append((sr, coils, coils[::-1]))
+    L = ctf.SENSOR_LABEL
+    refs = b''.join(n.split(b'-')[0].ljust(L, b'\x00') for n in names[:nref])
+    r.coeffInfo = []
+    for typ in (b'G1BR', b'G2BR'):
+        for n in names[nref:]:
+            co = list(rng.normal(size = nref)) + [0.] * (ctf.MAX_BALANCING - nref)
+            r.coeffInfo.append((n, typ, nref, refs) + tuple(co))
+    return r
+
+def test_round_trip(tmp_path):
+    a = tmp_path / 'a.res4'
+    b = tmp_path / 'b.res4'
+    ctf.write_res4_structs(str(a), makeRes4())
+    r = ctf.read_res4_structs(str(a))
+    ctf.write_res4_structs(str(b), r)
+    assert a.read_bytes() == b.read_bytes()
+
+    # The tuples read back are the unpacked structs, padding included.
+
+    r2 = ctf.read_res4_structs(str(b))
+    for k in ('genRes', 'runDesc', 'filterInfo', 'chanName', 'sensRes', 'coeffInfo'):
+        assert getattr(r, k) == getattr(r2, k)
+    assert r.coeffInfo[0][ctf.ci_sensorName] == b'MLC11-4408'.ljust(32, b'\x00')
+    assert len(r.coeffInfo[0][ctf.ci_sensorList]) == ctf.MAX_BALANCING * ctf.SENSOR_LABEL
+    assert r.filterInfo[1][1] == [(1.,), (2.,)]
+
+def test_header(tmp_path):
+    name = str(tmp_path / 'a.res4')
+    ctf.write_res4_structs(name, makeRes4())
+    h = ctf.readRes4Header(name)
+    r = ctf.readRes4(name)
+    assert h.chanFname == r.chanFname
+    assert list(h.chanType) == list(r.chanType)
+    assert (h.numTrials, h.numSamples, h.sampleRate) == (3, 100, 600.)